@@ -59,6 +59,11 @@
 #                not to be empty.
 #   command: /set plugins.var.python.auto_away.message "message"
 #
+# 'interval'
+#   description: Milliseconds to wait between sending AWAY to each
+#                server, so many servers aren't all sent it at once.
+#   command: /set plugins.var.python.auto_away.interval n
+#
 #
 # Changelog:
 #
@@ -87,6 +92,16 @@
 #                         /autoaway without arguments outputs current
 #                         settings.
 #                         Code rewrite.
+#   2026-10-18 - 0.4    - phyber:
+#                         Arm a single one-shot timer for when idletime
+#                         will be reached instead of polling every 10
+#                         seconds. Parsed idletime is cached and updated
+#                         from hook_config.
+#   2026-10-18 - 0.5    - phyber:
+#                         Track away state per server. Only servers we
+#                         marked away are returned from away, servers
+#                         the user set away by hand are left alone.
+#                         AWAY commands are spread out by 'interval'.
 
 try:
     import weechat as w
@@ -99,20 +114,31 @@ except Exception:
 # Script Properties
 SCRIPT_NAME    = "auto_away"
 SCRIPT_AUTHOR  = "Specimen"
-SCRIPT_VERSION = "0.3.3"
+SCRIPT_VERSION = "0.5"
 SCRIPT_LICENSE = "GPL3"
 SCRIPT_DESC    = "Simple auto-away script in Python"
 
 # Default values
 idletime = "20"
 message = "Idle"
+interval = "200"
+
+# Servers we have marked away, and servers still waiting for an AWAY
+away_servers = set()
+pending_servers = []
+away_target = False
+queue_hook = None
 
 # Functions
 def timer_hook_function():
-    ''' Timer hook to check inactivity '''
+    ''' One-shot timer hook for when we'll have been inactive long enough '''
     global timer_hook
-    if val_idletime() > 0:
-        timer_hook = w.hook_timer(10 * 1000, 60, 0, "idle_chk", "")
+    timer_hook = None
+    if idletime_value > 0:
+        remaining = idletime_value * 60 - int(w.info_get("inactivity", "")
+                                              or 0)
+        timer_hook = w.hook_timer(max(remaining, 1) * 1000, 0, 1,
+                                  "idle_chk", "")
     return w.WEECHAT_RC_OK
 
 def val_idletime():
@@ -126,34 +152,71 @@ def val_idletime():
 def idle_chk(data, remaining_calls):
     ''' Inactivity check, when to change status to away '''
     global timer_hook
-    if int(w.info_get("inactivity", "")) >= val_idletime() * 60:
-        w.unhook(timer_hook)
+    # One-shot timer, WeeChat has already removed it.
+    timer_hook = None
+    if int(w.info_get("inactivity", "")) >= idletime_value * 60:
         if not w.config_get_plugin('message'):
             w.config_set_plugin('message', message)
-        w.command("", "/away -all %s" 
-                  % w.config_get_plugin('message'))
-        if int(version) < 0x00030200:
-            ''' Workaround for /away -all bug in v. < 0.3.2 '''
-            servers = irc_servers()
-            if servers:
-                for server in servers:
-                    w.command(server, "/away %s" 
-                              % w.config_get_plugin('message'))
+        set_away(True, present_servers())
         input_hook_function()
+    else:
+        # There was activity since the timer was set, wait for the rest.
+        timer_hook_function()
     return w.WEECHAT_RC_OK
 
-def irc_servers():
-    ''' Disconnected IRC servers, workaround for /away -all bug 
-    in v. < 0.3.2 '''
+def present_servers():
+    ''' Connected IRC servers that aren't already away '''
     serverlist = w.infolist_get('irc_server','','')
-    buffers = []
+    servers = []
     if serverlist:
         while w.infolist_next(serverlist):
-            if w.infolist_integer(serverlist, 'is_connected') == 0:
-                buffers.append((w.infolist_pointer(serverlist,
-                               'buffer')))
+            if (w.infolist_integer(serverlist, 'is_connected') and
+                    not w.infolist_integer(serverlist, 'is_away')):
+                servers.append(w.infolist_string(serverlist, 'name'))
         w.infolist_free(serverlist)
-    return buffers
+    return servers
+
+def set_away(away, servers):
+    ''' Queue AWAY changes for servers, sent one per 'interval' ms '''
+    global away_target, queue_hook
+    away_target = away
+    pending_servers[:] = [server for server in servers
+                          if (server in away_servers) != away]
+    if not pending_servers:
+        return w.WEECHAT_RC_OK
+    # The first one goes right away, the rest are spread out.
+    away_queue_cb("", -1)
+    if pending_servers and not queue_hook:
+        try:
+            delay = max(int(w.config_get_plugin('interval')), 1)
+        except ValueError:
+            delay = int(interval)
+        queue_hook = w.hook_timer(delay, 0, 0, "away_queue_cb", "")
+    return w.WEECHAT_RC_OK
+
+def away_queue_cb(data, remaining_calls):
+    ''' Send AWAY to the next server in the queue '''
+    global queue_hook
+    if pending_servers:
+        server = pending_servers.pop(0)
+        buffer = w.info_get("irc_buffer", server)
+        if buffer and away_target and server not in away_servers:
+            w.command(buffer, "/away %s" % w.config_get_plugin('message'))
+            away_servers.add(server)
+        elif buffer and not away_target and server in away_servers:
+            w.command(buffer, "/away")
+            away_servers.discard(server)
+    if not pending_servers and queue_hook:
+        w.unhook(queue_hook)
+        queue_hook = None
+    return w.WEECHAT_RC_OK
+
+def disconnected_chk(data, signal, signal_data):
+    ''' A server disconnected, it's no longer away '''
+    away_servers.discard(signal_data)
+    if signal_data in pending_servers:
+        pending_servers.remove(signal_data)
+    return w.WEECHAT_RC_OK
 
 def input_hook_function():
     ''' Input hook to check for typing '''
@@ -166,13 +229,8 @@ def typing_chk(data, signal, signal_data):
     ''' Activity check, when to return from away '''
     global input_hook
     w.unhook(input_hook)
-    w.command("", "/away -all")
-    if int(version) < 0x00030200:
-        ''' Workaround for /away -all bug in v. < 0.3.2 '''
-        servers = irc_servers()
-        if servers:
-            for server in servers:
-                w.command(server, "/away")
+    input_hook = None
+    set_away(False, sorted(away_servers))
     timer_hook_function()
     return w.WEECHAT_RC_OK
 
@@ -184,7 +242,7 @@ def autoaway_cmd(data, buffer, args):
         w.config_set_plugin('idletime', value[0])
         if value[2]:
             w.config_set_plugin('message', value[2])
-    if val_idletime() > 0:
+    if idletime_value > 0:
         w.prnt(w.current_buffer(), 
                "%sauto-away%s settings:\n"
                "   Time:    %s%s%s minute(s)\n"
@@ -201,11 +259,14 @@ def autoaway_cmd(data, buffer, args):
 
 def switch_chk(data, option, value):
     ''' Checks when idletime setting is changed '''
-    global timer_hook, input_hook
+    global timer_hook, input_hook, idletime_value
+    idletime_value = val_idletime()
     if timer_hook:
         w.unhook(timer_hook)
+        timer_hook = None
     if input_hook:
         w.unhook(input_hook)
+        input_hook = None
     timer_hook_function()
     return w.WEECHAT_RC_OK
 
@@ -218,6 +279,8 @@ if __name__ == "__main__":
             w.config_set_plugin('idletime', idletime)	
         if not w.config_get_plugin('message'): 
             w.config_set_plugin('message', message)
+        if not w.config_get_plugin('interval'):
+            w.config_set_plugin('interval', interval)
             
         w.hook_command("autoaway", 
                        "Set away status automatically after a period of "
@@ -246,9 +309,10 @@ if __name__ == "__main__":
                        "autoaway_cmd", "")
         w.hook_config("plugins.var.python.auto_away.idletime",
                       "switch_chk", "")
+        w.hook_signal("irc_server_disconnected", "disconnected_chk", "")
                       
-        version = w.info_get("version_number", "") or 0
         timer_hook = None
         input_hook = None
+        idletime_value = val_idletime()
 
         timer_hook_function()
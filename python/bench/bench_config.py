@@ -0,0 +1,60 @@
+"""
+Micro-benchmark of whitelist.py Config.get_value.
+
+Compares the cached get_value against the previous uncached lookup, which
+searched for the section and option and resolved the config_* function on
+every call. Uses the stub weechat module in this directory.
+
+    python bench/bench_config.py [iterations]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import weechat  # noqa: E402
+import whitelist  # noqa: E402
+
+
+def uncached_get_value(cfg, section_name, option_name):
+    """The get_value implementation before values were cached."""
+    section = weechat.config_search_section(
+        cfg._config_file, section_name
+    )
+
+    option = weechat.config_search_option(
+        cfg._config_file, section, option_name
+    )
+
+    config_function = "config_{type}".format(
+        type=whitelist.SCRIPT_CONFIG[section_name][option_name]['type'])
+
+    return getattr(weechat, config_function)(option)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    weechat.set_script(whitelist)
+    cfg = whitelist.Config(
+        'whitelist',
+        'whitelist_config_reload_cb',
+        '',
+        'whitelist_config_value_change_cb')
+
+    cases = (
+        ("before", lambda: uncached_get_value(
+            cfg, 'general', 'notification')),
+        ("after", lambda: cfg.get_value('general', 'notification')),
+    )
+
+    for (name, func) in cases:
+        seconds = min(timeit.repeat(func, number=iterations, repeat=3))
+        print("{name:>6}: {ns:8.1f} ns/call".format(
+            name=name,
+            ns=seconds / iterations * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Micro-benchmark of whitelist.py host mask lookups as the list grows.
+
+Builds whitelists of 10 up to 100,000 host masks, a mix of ISP suffixes,
+cloak namespaces, exact hosts, IP ranges and a few masks with wildcards in
+the middle, and times HostIndex.match against the previous single combined
+regex for hosts that match and hosts that don't. A few known cases are
+checked first.
+
+    python bench/bench_hosts.py [iterations]
+"""
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import whitelist  # noqa: E402
+
+SIZES = (10, 100, 1000, 10000, 100000)
+
+# Regex alternations get slow to build past this, skip the comparison.
+MAX_REGEX_SIZE = 10000
+
+
+def make_masks(count, rng):
+    """Return count host masks, mostly of the kinds HostIndex indexes."""
+    masks = []
+    for n in range(count):
+        kind = n % 20
+        if kind < 8:
+            masks.append("*!*@*.isp{n}.example".format(n=n))
+        elif kind < 12:
+            masks.append("*!*@user/name{n}/*".format(n=n))
+        elif kind < 17:
+            masks.append("*!~user{n}@host{n}.example".format(n=n))
+        elif kind < 19:
+            masks.append("*!*@10.{a}.{b}.0/24".format(
+                a=n // 256 % 256, b=n % 256))
+        else:
+            masks.append("*!*@*.mid{n}.*.example".format(n=rng.randint(0, 9)))
+    return masks
+
+
+def uncached_regex(masks):
+    """The single regex used before masks were indexed."""
+    return re.compile("(?:{regexes})$".format(regexes="|".join(
+        "(?:{regex})".format(regex=whitelist.host_to_regex(mask))
+        for mask in masks)))
+
+
+# (masks, host, expected) checked before timing anything.
+CHECKS = (
+    (("*!*@a?c.example.com", "*!*@x*y.net"),
+     "n!u@abc.example.com", True),
+    # The fallback regex must match the whole host for every mask.
+    (("*!*@a?c.example.com", "*!*@x*y.net"),
+     "n!u@abc.example.com.evil.org", False),
+    (("*!*@a?c.example.com", "*!*@x*y.net"),
+     "n!u@xay.net.evil.org", False),
+    (("*!*@*.isp.example",), "n!u@dsl.isp.example.evil.org", False),
+    (("*!*@user/*",), "n!u@user/name", True),
+    (("*!*@10.0.0.0/8",), "n!u@10.1.2.3", True),
+)
+
+
+def check():
+    """Exit with an error if HostIndex gets any of CHECKS wrong."""
+    for (masks, host, expected) in CHECKS:
+        if whitelist.HostIndex(masks).match(host) != expected:
+            sys.exit("HostIndex({masks}).match({host!r}) is not "
+                     "{expected}".format(masks=list(masks), host=host,
+                                         expected=expected))
+
+
+def main():
+    check()
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rng = random.Random(0)
+
+    hosts = (
+        ("hit", "nick!~u@dsl-1.isp3.example"),
+        ("miss", "nick!~u@dsl-1.other.example"),
+    )
+
+    print("{masks:>8} {host:>5} {index:>12} {regex:>12}".format(
+        masks="masks", host="host", index="index ns", regex="regex ns"))
+
+    for size in SIZES:
+        masks = make_masks(size, rng)
+        index = whitelist.HostIndex(masks)
+        regex = uncached_regex(masks) if size <= MAX_REGEX_SIZE else None
+
+        for (name, host) in hosts:
+            seconds = min(timeit.repeat(
+                lambda: index.match(host), number=iterations, repeat=3))
+            index_ns = seconds / iterations * 1e9
+
+            regex_ns = "-"
+            if regex is not None:
+                number = max(iterations // size, 10)
+                seconds = min(timeit.repeat(
+                    lambda: regex.match(host), number=number, repeat=3))
+                regex_ns = "{ns:.1f}".format(ns=seconds / number * 1e9)
+
+            print("{masks:>8} {host:>5} {index:>12.1f} {regex:>12}".format(
+                masks=size, host=name, index=index_ns, regex=regex_ns))
+
+
+if __name__ == '__main__':
+    main()
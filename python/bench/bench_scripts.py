@@ -0,0 +1,110 @@
+"""
+Benchmark the Python scripts' callbacks against recorded IRC traffic.
+
+Loads whitelist.py, whois_in_active_buffer.py and title.py under the stub
+weechat module, replays a traffic file through them and prints latency
+percentiles and throughput for every callback that ran. A few known cases
+are checked first.
+
+    python bench/bench_scripts.py [--repeat N] [traffic file]
+
+The default traffic file is bench/traffic/sample.log.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import weechat  # noqa: E402
+import whitelist  # noqa: E402
+from harness import BENCH_DIR, Harness, read_traffic  # noqa: E402
+
+SCRIPTS = (
+    "whitelist.py",
+    "whois_in_active_buffer.py",
+    "title.py",
+)
+
+
+def check():
+    """Exit with an error if a known case goes wrong."""
+    # Adding A again evicts A's oldest message, which must not lose the
+    # new one.
+    held = whitelist.HeldMessages(size=3, per_sender=10)
+    for nick in ("A", "B", "C", "A"):
+        held.add("server", nick, "host", nick)
+    taken = held.take("a")
+    if len(held) != 2 or [m[2] for m in taken.get("server", [])] != ["A"]:
+        sys.exit("HeldMessages lost a message: {taken}, {count} left".format(
+            taken=taken, count=len(held)))
+
+
+def run(traffic, repeat):
+    """Load the scripts and replay traffic repeat times.
+
+    Returns (harness, wall_ns).
+    """
+    harness = Harness()
+    for (_, server, _) in traffic:
+        if server not in harness.network.servers:
+            harness.network.add_server(server)
+
+    for script in SCRIPTS:
+        harness.load(script)
+
+    # Whitelist a few of the senders in the sample so both the allow and
+    # block paths are exercised.
+    weechat.run_command("", "/whitelist add nick alice")
+    weechat.run_command("", "/whitelist add host *!*@*.isp.example")
+    weechat.run_command("", "/whitelist add channel #python")
+    del weechat.printed[:]
+
+    start = time.perf_counter_ns()
+    for n in range(repeat):
+        previous = None
+        for (timestamp, server, raw) in traffic:
+            if previous is not None:
+                harness.advance(int((timestamp - previous) * 1000))
+            previous = timestamp
+            harness.feed(server, raw)
+
+        # Switch buffer between passes, as the user reading them would.
+        buffers = sorted(weechat.buffers)
+        harness.switch_buffer(buffers[n % len(buffers)])
+    wall_ns = time.perf_counter_ns() - start
+
+    weechat.unload_scripts()
+    return (harness, wall_ns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "traffic",
+        nargs="?",
+        default=os.path.join(BENCH_DIR, "traffic", "sample.log"),
+        help="traffic file, lines of '<seconds> <server> <raw line>'")
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1000,
+        help="number of times to replay the traffic (default: 1000)")
+    args = parser.parse_args()
+
+    check()
+    traffic = list(read_traffic(args.traffic))
+
+    # The scripts write their logs and databases to the WeeChat directory.
+    with tempfile.TemporaryDirectory(prefix="weechat-bench-") as weechat_dir:
+        weechat.set_info('weechat_dir', weechat_dir)
+        (harness, wall_ns) = run(traffic, args.repeat)
+
+    harness.report(wall_ns=wall_ns)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,376 @@
+"""
+Drive scripts under the stub weechat module and time their callbacks.
+
+The Harness loads scripts as WeeChat would, feeds raw IRC lines through
+the irc_in_* modifiers and irc_in*_* signals that scripts hook, and
+records how long every callback call takes. Network keeps the servers,
+channels, nicks, buffers and hotlist the stub reports through infolists
+and infos in step with the traffic that's fed in.
+"""
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.dirname(BENCH_DIR)
+
+# Make sure scripts import the stub and not a real weechat module.
+if BENCH_DIR not in sys.path:
+    sys.path.insert(0, BENCH_DIR)
+
+import weechat  # noqa: E402
+
+NICK_PREFIXES = "~&@%+!"
+CHANNEL_PREFIX = ('#', '&')
+
+# Hotlist priorities, as in WeeChat.
+HOTLIST_MESSAGE = 1
+HOTLIST_PRIVATE = 2
+HOTLIST_HIGHLIGHT = 3
+
+
+def split_line(raw):
+    """Split a raw IRC line into (nick, command, params)."""
+    if raw.startswith('@'):
+        raw = raw.split(' ', 1)[1]
+
+    source = ""
+    if raw.startswith(':'):
+        (source, _, raw) = raw[1:].partition(' ')
+
+    if ' :' in raw:
+        (raw, trailing) = raw.split(' :', 1)
+        params = raw.split()
+        params.append(trailing)
+    else:
+        params = raw.split()
+
+    command = params.pop(0) if params else ""
+    return (source.split('!', 1)[0], command, params)
+
+
+def read_traffic(path):
+    """Yield (timestamp, server, raw) from a traffic file.
+
+    Each line is "<seconds> <server> <raw IRC line>". Blank lines and lines
+    starting with # are skipped.
+    """
+    with open(path) as traffic:
+        for line in traffic:
+            line = line.rstrip("\r\n")
+            if not line or line.startswith('#'):
+                continue
+            (timestamp, server, raw) = line.split(' ', 2)
+            yield (float(timestamp), server, raw)
+
+
+def percentile(sorted_values, pct):
+    """Return the pct percentile of an already sorted list."""
+    if not sorted_values:
+        return 0
+    index = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class Network(object):
+    """IRC state exposed to scripts through the stub's infolists and infos."""
+    def __init__(self, own_nick="me"):
+        self.own_nick = own_nick
+        self.servers = {}
+        self.hotlist = []
+        self._buffer_number = 1
+
+        weechat.set_infolist('irc_server', self._irc_server_infolist)
+        weechat.set_infolist('irc_channel', self._irc_channel_infolist)
+        weechat.set_infolist('irc_nick', self._irc_nick_infolist)
+        weechat.set_infolist('hotlist', self._hotlist_infolist)
+        weechat.set_info('irc_nick', self._irc_nick_info)
+        weechat.set_info('irc_buffer', self._irc_buffer_info)
+        weechat.set_hdata('buffer', 'hotlist', self._buffer_hotlist)
+        weechat.set_hdata('hotlist', 'priority', self._hotlist_priority)
+
+    def add_server(self, server, address=None):
+        """Add a connected server with a server buffer."""
+        self.servers[server] = {
+            'address': address or "irc.{server}.net".format(server=server),
+            'channels': {},
+            'buffer': self._add_buffer("server." + server, server),
+        }
+
+    def add_channel(self, server, channel, nicks=()):
+        """Add a channel with a buffer and the given nicks."""
+        if server not in self.servers:
+            self.add_server(server)
+        channels = self.servers[server]['channels']
+        if channel not in channels:
+            channels[channel] = {
+                'nicks': set([self.own_nick]),
+                'buffer': self._add_buffer(
+                    "{server}.{channel}".format(server=server,
+                                                channel=channel),
+                    channel),
+            }
+        channels[channel]['nicks'].update(nicks)
+
+    def _add_buffer(self, name, short_name):
+        self._buffer_number += 1
+        return weechat.add_buffer(
+            "0x{number:x}".format(number=self._buffer_number),
+            name=name,
+            short_name=short_name,
+            number=self._buffer_number)
+
+    def apply(self, server, raw):
+        """Update the state for a raw line, as the irc plugin would.
+
+        Returns the buffer whose hotlist entry changed, or None.
+        """
+        (nick, command, params) = split_line(raw)
+        channels = self.servers.get(server, {}).get('channels', {})
+        command = command.upper()
+
+        if command == 'JOIN' and params:
+            self.add_channel(server, params[0], (nick,))
+        elif command == 'PART' and params:
+            for channel in params[0].split(","):
+                if channel in channels:
+                    channels[channel]['nicks'].discard(nick)
+        elif command == 'KICK' and len(params) > 1:
+            if params[0] in channels:
+                channels[params[0]]['nicks'].discard(params[1])
+        elif command == 'QUIT':
+            for channel in channels.values():
+                channel['nicks'].discard(nick)
+        elif command == 'NICK' and params:
+            for channel in channels.values():
+                if nick in channel['nicks']:
+                    channel['nicks'].discard(nick)
+                    channel['nicks'].add(params[0])
+        elif command == '353' and len(params) > 3 and params[2] in channels:
+            # Names for a channel we're not in are only printed.
+            self.add_channel(server, params[2], [
+                name.lstrip(NICK_PREFIXES).split('!', 1)[0]
+                for name in params[3].split()])
+        elif command == 'PRIVMSG' and params:
+            return self._message(server, nick, params[0])
+
+        return None
+
+    def _message(self, server, nick, target):
+        """Add a message to the hotlist.
+
+        Returns the buffer whose hotlist entry changed, or None.
+        """
+        if target.startswith(CHANNEL_PREFIX):
+            channel = self.servers[server]['channels'].get(target)
+            if channel is None:
+                return None
+            (buffer, priority) = (channel['buffer'], HOTLIST_MESSAGE)
+        else:
+            buffer = self._irc_buffer_info(
+                "{server},{nick}".format(server=server, nick=nick))
+            priority = HOTLIST_PRIVATE
+
+        if buffer == weechat.current_buffer():
+            return None
+
+        for entry in self.hotlist:
+            if entry['buffer_pointer'] == buffer:
+                if entry['priority'] >= priority:
+                    return None
+                # WeeChat re-adds a raised buffer, as the newest entry.
+                self.hotlist.remove(entry)
+                break
+
+        self.hotlist.append({
+            'priority': priority,
+            'buffer_pointer': buffer,
+            'buffer_number': weechat.buffer_get_integer(buffer, 'number'),
+            'plugin_name': "irc",
+            'buffer_name': weechat.buffer_get_string(buffer, 'name'),
+        })
+        # Sorted as with the default weechat.look.hotlist_sort, highest
+        # priority first, then oldest first.
+        self.hotlist.sort(key=lambda entry: -entry['priority'])
+        return buffer
+
+    def switch_buffer(self, buffer):
+        """Make buffer current and drop it from the hotlist."""
+        weechat.current_buffer_pointer = buffer
+        self.hotlist = [entry for entry in self.hotlist
+                        if entry['buffer_pointer'] != buffer]
+
+    def _buffer_hotlist(self, buffer):
+        for entry in self.hotlist:
+            if entry['buffer_pointer'] == buffer:
+                return buffer
+        return None
+
+    def _hotlist_priority(self, pointer):
+        for entry in self.hotlist:
+            if entry['buffer_pointer'] == pointer:
+                return entry['priority']
+        return None
+
+    def _irc_server_infolist(self, pointer, args):
+        return [
+            {
+                'name': server,
+                'buffer': state['buffer'],
+                'is_connected': 1,
+                'current_address': state['address'],
+                'nick': self.own_nick,
+            }
+            for server, state in self.servers.items()
+            if not args or args == server
+        ]
+
+    def _irc_channel_infolist(self, pointer, args):
+        channels = self.servers.get(args.split(',')[0], {}).get('channels', {})
+        return [
+            {'name': name, 'buffer': channel['buffer'], 'type': 0}
+            for name, channel in channels.items()
+        ]
+
+    def _irc_nick_infolist(self, pointer, args):
+        (server, _, channel) = args.partition(',')
+        channels = self.servers.get(server, {}).get('channels', {})
+        nicks = channels.get(channel, {}).get('nicks', ())
+        return [{'name': nick, 'host': "", 'prefixes': " "} for nick in nicks]
+
+    def _hotlist_infolist(self, pointer, args):
+        return [dict(entry) for entry in self.hotlist]
+
+    def _irc_nick_info(self, server):
+        return self.own_nick if server in self.servers else ""
+
+    def _irc_buffer_info(self, args):
+        (server, _, name) = args.partition(',')
+        state = self.servers.get(server)
+        if state is None:
+            return ""
+        channel = state['channels'].get(name)
+        if channel is not None:
+            return channel['buffer']
+        query = weechat.buffer_search(
+            "irc", "{server}.{name}".format(server=server, name=name))
+        return query or state['buffer']
+
+
+class Harness(object):
+    """Loads scripts and times every callback the stub runs."""
+    def __init__(self, network=None):
+        self.network = network or Network()
+        self.timings = {}
+        self.failures = {}
+        self.lines = 0
+        self.elapsed_ns = 0
+
+    def load(self, name):
+        """Load a script from the scripts directory, False if it fails."""
+        path = os.path.join(SCRIPTS_DIR, name)
+        try:
+            weechat.load_script(path)
+        except (Exception, SystemExit) as err:
+            self.failures[name] = "{type}: {err}".format(
+                type=type(err).__name__, err=err)
+            return False
+        return True
+
+    def _timed(self, hook, *args):
+        """Run a hook's callback, recording its duration."""
+        start = time.perf_counter_ns()
+        ret = hook.callback(*args)
+        duration = time.perf_counter_ns() - start
+
+        key = "{script}:{callback}".format(
+            script=hook.callback.script, callback=hook.callback.name)
+        self.timings.setdefault(key, []).append(duration)
+        self.elapsed_ns += duration
+        return ret
+
+    def feed(self, server, raw):
+        """Feed a raw line through modifiers and signals.
+
+        Returns the line after modifiers, an empty string if a script
+        dropped it.
+        """
+        self.lines += 1
+        command = split_line(raw)[1].lower()
+
+        result = weechat.run_modifier(
+            "irc_in_" + command, server, raw, self._timed)
+        if not result:
+            return result
+
+        hotlist_buffer = self.network.apply(server, result)
+        for stage in ("irc_in", "irc_in2"):
+            weechat.send_signal(
+                "{server},{stage}_{command}".format(
+                    server=server, stage=stage, command=command),
+                result,
+                self._timed)
+
+        if hotlist_buffer is not None:
+            self.signal("hotlist_changed", hotlist_buffer)
+
+        return result
+
+    def signal(self, signal, signal_data):
+        """Send a signal to the scripts."""
+        weechat.send_signal(signal, signal_data, self._timed)
+
+    def switch_buffer(self, buffer):
+        """Switch buffer, as the user would."""
+        self.network.switch_buffer(buffer)
+        self.signal("hotlist_changed", buffer)
+        self.signal("buffer_switch", buffer)
+
+    def advance(self, milliseconds):
+        """Move the clock forward, running any timers that fall due."""
+        weechat.advance_clock(milliseconds, self._timed)
+
+    def reset(self):
+        """Forget the recorded timings."""
+        self.timings = {}
+        self.lines = 0
+        self.elapsed_ns = 0
+
+    def report(self, out=sys.stdout, wall_ns=None):
+        """Print latency percentiles and throughput per callback."""
+        out.write("{name:<52} {calls:>8} {mean:>9} {p50:>9} {p90:>9} "
+                  "{p99:>9} {max:>9} {rate:>11}\n".format(
+                      name="callback", calls="calls", mean="mean us",
+                      p50="p50 us", p90="p90 us", p99="p99 us",
+                      max="max us", rate="calls/s"))
+
+        for key in sorted(self.timings):
+            values = sorted(self.timings[key])
+            total = sum(values)
+            out.write("{name:<52} {calls:>8} {mean:>9.2f} {p50:>9.2f} "
+                      "{p90:>9.2f} {p99:>9.2f} {max:>9.2f} {rate:>11.0f}\n"
+                      .format(
+                          name=key,
+                          calls=len(values),
+                          mean=total / len(values) / 1e3,
+                          p50=percentile(values, 50) / 1e3,
+                          p90=percentile(values, 90) / 1e3,
+                          p99=percentile(values, 99) / 1e3,
+                          max=values[-1] / 1e3,
+                          rate=len(values) / (total / 1e9) if total else 0))
+
+        if self.lines:
+            out.write("\n{lines} lines, {cb:.1f} ms in callbacks, "
+                      "{rate:.0f} lines/s through callbacks".format(
+                          lines=self.lines,
+                          cb=self.elapsed_ns / 1e6,
+                          rate=self.lines / (self.elapsed_ns / 1e9)
+                          if self.elapsed_ns else 0))
+            if wall_ns:
+                out.write(", {rate:.0f} lines/s wall clock".format(
+                    rate=self.lines / (wall_ns / 1e9)))
+            out.write("\n")
+
+        for name, failure in sorted(self.failures.items()):
+            out.write("{name} failed to load: {failure}\n".format(
+                name=name, failure=failure))
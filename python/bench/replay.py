@@ -0,0 +1,248 @@
+"""
+Replay captured or synthetic IRC traffic through the scripts' callbacks.
+
+Feeds irc_in_privmsg, irc_in_3xx and the other irc_in_* modifiers and
+signals into whitelist.py, whois_in_active_buffer.py and message_parse.py
+under the stub weechat module, then prints a throughput and latency
+report. Traffic either comes from a capture file, in the format read by
+harness.read_traffic(), or from a generator that builds a network of
+channels and nicks and sends queries, channel chatter, join floods and
+WHOIS replies at given rates.
+
+Replay is time compressed by default: events are fed as fast as possible
+and timers run on a virtual clock. With --realtime, events are fed at
+their timestamps (scaled by --speed) and the report includes how far
+behind schedule the replay fell.
+
+    python bench/replay.py capture.log
+    python bench/replay.py --generate --channels 150 --nicks 40000 \\
+        --queries 200 --spam-ratio 0.9 --joins 500 --duration 30
+    python bench/replay.py --generate --write synthetic.log
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import weechat  # noqa: E402
+from harness import Harness, read_traffic  # noqa: E402
+
+SCRIPTS = (
+    "whitelist.py",
+    "whois_in_active_buffer.py",
+    "message_parse.py",
+)
+
+SERVER_NAME = "irc.example.net"
+
+
+def nick_host(nick):
+    """Return a nick!user@host for a generated nick."""
+    return "{nick}!~{nick}@{nick}.users.example".format(nick=nick)
+
+
+def generate(server="gen", own_nick="me", channels=20, nicks=2000,
+             queries=10.0, spam_ratio=0.5, chatter=100.0, joins=0.0,
+             whois=1.0, duration=10.0, seed=0):
+    """Yield (timestamp, server, raw) for a synthetic network.
+
+    Rates are events per second. Every nick is put in one to three
+    channels. Spam queries come from hosts that share no channel with us.
+    """
+    rng = random.Random(seed)
+    channel_names = ["#chan{n}".format(n=n) for n in range(channels)]
+    nick_names = ["user{n}".format(n=n) for n in range(nicks)]
+
+    members = dict((channel, []) for channel in channel_names)
+    for nick in nick_names:
+        for channel in rng.sample(channel_names, min(channels,
+                                                     rng.randint(1, 3))):
+            members[channel].append(nick)
+
+    # Join our channels, with names sent in batches like a real server.
+    for channel in channel_names:
+        yield (0.0, server, ":{host} JOIN {channel}".format(
+            host=nick_host(own_nick), channel=channel))
+        names = members[channel]
+        for start in range(0, len(names), 50):
+            yield (0.0, server, ":{srv} 353 {me} = {channel} :{names}".format(
+                srv=SERVER_NAME, me=own_nick, channel=channel,
+                names=" ".join(names[start:start + 50])))
+        yield (0.0, server, ":{srv} 366 {me} {channel} :End of /NAMES "
+               "list.".format(srv=SERVER_NAME, me=own_nick, channel=channel))
+
+    events = []
+    for (rate, kind) in ((queries, 'query'), (chatter, 'chatter'),
+                         (joins, 'join'), (whois, 'whois')):
+        if rate <= 0:
+            continue
+        timestamp = rng.expovariate(rate)
+        while timestamp < duration:
+            events.append((timestamp, kind))
+            timestamp += rng.expovariate(rate)
+    events.sort()
+
+    joined = 0
+    for (timestamp, kind) in events:
+        if kind == 'query':
+            if rng.random() < spam_ratio:
+                source = "spam{n}!~x@198.51.{a}.{b}".format(
+                    n=rng.randint(0, 9999),
+                    a=rng.randint(0, 255),
+                    b=rng.randint(1, 254))
+            else:
+                source = nick_host(rng.choice(nick_names))
+            yield (timestamp, server, ":{source} PRIVMSG {me} :hello "
+                   "there".format(source=source, me=own_nick))
+
+        elif kind == 'chatter':
+            channel = rng.choice(channel_names)
+            nick = rng.choice(members[channel] or [own_nick])
+            yield (timestamp, server, ":{host} PRIVMSG {channel} :some "
+                   "channel chatter".format(host=nick_host(nick),
+                                            channel=channel))
+
+        elif kind == 'join':
+            joined += 1
+            yield (timestamp, server, ":{host} JOIN {channel}".format(
+                host=nick_host("flood{n}".format(n=joined)),
+                channel=rng.choice(channel_names)))
+
+        elif kind == 'whois':
+            nick = rng.choice(nick_names)
+            prefix = ":{srv} {{numeric}} {me} {nick}".format(
+                srv=SERVER_NAME, me=own_nick, nick=nick)
+            for line in (
+                    "311 ~{nick} {nick}.users.example * :{nick}",
+                    "319 :#chan0",
+                    "312 {srv} :Example server",
+                    "317 12 1700000000 :seconds idle, signon time",
+                    "318 :End of /WHOIS list."):
+                (numeric, _, rest) = line.partition(' ')
+                yield (timestamp, server, "{prefix} {rest}".format(
+                    prefix=prefix.format(numeric=numeric),
+                    rest=rest.format(nick=nick, srv=SERVER_NAME)))
+
+
+def write_traffic(path, traffic):
+    """Write traffic in the capture file format."""
+    with open(path, 'w') as out:
+        for (timestamp, server, raw) in traffic:
+            out.write("{timestamp:.3f} {server} {raw}\n".format(
+                timestamp=timestamp, server=server, raw=raw))
+
+
+def replay(harness, traffic, realtime=False, speed=1.0):
+    """Feed traffic to the harness, return (wall_ns, lags_ns)."""
+    lags = []
+    previous = None
+    start = time.perf_counter_ns()
+
+    for (timestamp, server, raw) in traffic:
+        if previous is not None and timestamp > previous:
+            harness.advance(int((timestamp - previous) * 1000))
+        previous = timestamp
+
+        if realtime:
+            due = start + int(timestamp / speed * 1e9)
+            now = time.perf_counter_ns()
+            if now < due:
+                time.sleep((due - now) / 1e9)
+            else:
+                lags.append(now - due)
+
+        harness.feed(server, raw)
+
+    return (time.perf_counter_ns() - start, lags)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("capture", nargs="?",
+                        help="capture file to replay")
+    parser.add_argument("--generate", action="store_true",
+                        help="replay synthetic traffic")
+    parser.add_argument("--write", metavar="FILE",
+                        help="write the traffic to FILE instead of "
+                             "replaying it")
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--nicks", type=int, default=2000)
+    parser.add_argument("--queries", type=float, default=10.0,
+                        help="queries per second")
+    parser.add_argument("--spam-ratio", type=float, default=0.5,
+                        help="fraction of queries from strangers")
+    parser.add_argument("--chatter", type=float, default=100.0,
+                        help="channel messages per second")
+    parser.add_argument("--joins", type=float, default=0.0,
+                        help="joins per second from new nicks")
+    parser.add_argument("--whois", type=float, default=1.0,
+                        help="WHOIS replies per second")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="seconds of traffic to generate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--realtime", action="store_true",
+                        help="feed events at their timestamps")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="realtime speed factor")
+    parser.add_argument("--whitelist", action="append", default=[],
+                        metavar="'TYPE ARG'",
+                        help="whitelist entry to add, eg. 'network gen', "
+                             "may be repeated (default: 'network gen')")
+    parser.add_argument("--scripts", nargs="+", default=list(SCRIPTS),
+                        help="scripts to load")
+    args = parser.parse_args()
+
+    if args.generate:
+        traffic = generate(
+            channels=args.channels, nicks=args.nicks, queries=args.queries,
+            spam_ratio=args.spam_ratio, chatter=args.chatter,
+            joins=args.joins, whois=args.whois, duration=args.duration,
+            seed=args.seed)
+    elif args.capture:
+        traffic = read_traffic(args.capture)
+    else:
+        parser.error("give a capture file or --generate")
+
+    if args.write:
+        write_traffic(args.write, traffic)
+        return
+
+    traffic = list(traffic)
+
+    # The scripts write their logs and databases to the WeeChat directory.
+    with tempfile.TemporaryDirectory(prefix="weechat-bench-") as weechat_dir:
+        weechat.set_info('weechat_dir', weechat_dir)
+
+        harness = Harness()
+        for (_, server, _) in traffic:
+            if server not in harness.network.servers:
+                harness.network.add_server(server)
+
+        for script in args.scripts:
+            harness.load(script)
+
+        for entry in args.whitelist or ["network gen"]:
+            weechat.run_command("", "/whitelist add {entry}".format(
+                entry=entry))
+        del weechat.printed[:]
+
+        (wall_ns, lags) = replay(harness, traffic, args.realtime, args.speed)
+        weechat.unload_scripts()
+
+    harness.report(wall_ns=wall_ns)
+    if args.realtime:
+        sys.stdout.write(
+            "{late} of {lines} events late, mean lag {mean:.2f} ms, "
+            "max lag {max:.2f} ms\n".format(
+                late=len(lags),
+                lines=len(traffic),
+                mean=sum(lags) / len(lags) / 1e6 if lags else 0,
+                max=max(lags) / 1e6 if lags else 0))
+
+
+if __name__ == '__main__':
+    main()
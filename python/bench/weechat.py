@@ -0,0 +1,632 @@
+"""
+Stub of the WeeChat scripting API for running scripts outside WeeChat.
+
+Only the parts of the API used by the scripts in this repository are
+implemented. Callbacks are given by name, as in WeeChat, and looked up in
+the namespace of the script that was current when the hook, config or
+option was created. Use set_script() to make a module or globals dict
+current, or load_script() to run a script file as WeeChat would.
+"""
+import fnmatch
+import os
+
+WEECHAT_RC_OK = 0
+WEECHAT_RC_OK_EAT = 1
+WEECHAT_RC_ERROR = -1
+
+WEECHAT_CONFIG_READ_OK = 0
+WEECHAT_CONFIG_READ_MEMORY_ERROR = -1
+WEECHAT_CONFIG_READ_FILE_NOT_FOUND = -2
+
+WEECHAT_CONFIG_OPTION_SET_OK_CHANGED = 2
+WEECHAT_CONFIG_OPTION_SET_OK_SAME_VALUE = 1
+WEECHAT_CONFIG_OPTION_SET_ERROR = 0
+
+WEECHAT_LIST_POS_SORT = "sort"
+
+WEECHAT_HOOK_PROCESS_RUNNING = -1
+WEECHAT_HOOK_PROCESS_ERROR = -2
+WEECHAT_LIST_POS_BEGINNING = "beginning"
+WEECHAT_LIST_POS_END = "end"
+
+# Hex version reported by info_get("version_number").
+VERSION_NUMBER = 0x03080000
+
+_script = None
+_script_name = ""
+
+
+def set_script(namespace, name=""):
+    """Set the module or globals dict that new callbacks are looked up in."""
+    global _script, _script_name
+    if not isinstance(namespace, dict):
+        namespace = vars(namespace)
+    _script = namespace
+    _script_name = name
+
+
+def load_script(path):
+    """Run a script file as __main__, as WeeChat does, and return its globals.
+
+    Hooks created while loading are bound to the script's namespace.
+    """
+    namespace = {'__name__': '__main__', '__file__': path}
+    set_script(namespace, os.path.splitext(os.path.basename(path))[0])
+
+    with open(path) as script:
+        code = compile(script.read(), path, 'exec')
+    exec(code, namespace)
+
+    return namespace
+
+
+class _Callback(object):
+    """A callback name bound to the namespace it should be looked up in."""
+    def __init__(self, name):
+        self.name = name
+        self.namespace = _script
+        self.script = _script_name
+
+    def __bool__(self):
+        return bool(self.name)
+
+    __nonzero__ = __bool__
+
+    def func(self):
+        return self.namespace[self.name]
+
+    def __call__(self, *args):
+        global _script, _script_name
+        if not self.name:
+            return WEECHAT_RC_OK
+
+        # Run with the owning script current, for config_get_plugin etc.
+        previous = (_script, _script_name)
+        (_script, _script_name) = (self.namespace, self.script)
+        try:
+            return self.func()(*args)
+        finally:
+            (_script, _script_name) = previous
+
+
+# Output
+
+printed = []
+
+
+def prnt(buffer, message):
+    printed.append((buffer, message))
+
+
+def prnt_date_tags(buffer, date, tags, message):
+    printed.append((buffer, message))
+
+
+def color(name):
+    return ""
+
+
+def prefix(name):
+    return ""
+
+
+def register(name, author, version, license, description, shutdown_function,
+             charset):
+    global _script_name
+    _script_name = name
+    shutdown_functions.append(_Callback(shutdown_function))
+    return 1
+
+
+shutdown_functions = []
+
+
+def unload_scripts():
+    """Call the shutdown function of every registered script."""
+    while shutdown_functions:
+        shutdown_functions.pop()()
+
+
+# Infos
+
+infos = {
+    'version_number': lambda args: str(VERSION_NUMBER),
+    'weechat_dir': lambda args: "/tmp",
+    'inactivity': lambda args: "0",
+}
+
+
+def set_info(name, value):
+    """Set the result of info_get(name, ...), a string or a function."""
+    if callable(value):
+        infos[name] = value
+    else:
+        infos[name] = lambda args: value
+
+
+def info_get(name, arguments):
+    try:
+        return infos[name](arguments)
+    except KeyError:
+        return ""
+
+
+def _irc_message_parse(message, server=""):
+    """Python version of the irc_message_parse info hashtable."""
+    details = {
+        'tags': "",
+        'message_without_tags': message,
+        'nick': "",
+        'host': "",
+        'command': "",
+        'channel': "",
+        'arguments': "",
+        'text': "",
+    }
+
+    if message.startswith('@'):
+        (details['tags'], _, message) = message[1:].partition(' ')
+        details['message_without_tags'] = message
+
+    if message.startswith(':'):
+        (source, _, message) = message[1:].partition(' ')
+        details['host'] = source
+        details['nick'] = source.split('!', 1)[0]
+
+    (command, _, arguments) = message.partition(' ')
+    details['command'] = command
+    details['arguments'] = arguments
+
+    target = arguments.partition(' ')[0]
+    if not target.startswith(':'):
+        details['channel'] = target
+
+    if ' :' in arguments:
+        details['text'] = arguments.split(' :', 1)[1]
+    elif arguments.startswith(':'):
+        details['text'] = arguments[1:]
+
+    return details
+
+
+info_hashtables = {
+    'irc_message_parse': lambda table: _irc_message_parse(
+        table.get('message', ""), table.get('server', "")),
+}
+
+
+def info_get_hashtable(name, hashtable):
+    try:
+        return info_hashtables[name](hashtable)
+    except KeyError:
+        return {}
+
+
+# Hooks
+
+hooks = []
+commands = []
+
+
+class _Hook(object):
+    def __init__(self, kind, name, callback, data, **extra):
+        self.kind = kind
+        self.name = name
+        self.callback = _Callback(callback)
+        self.data = data
+        self.calls = 0
+        self.__dict__.update(extra)
+
+
+def _hook(kind, name, callback, data, **extra):
+    hook = _Hook(kind, name, callback, data, **extra)
+    hooks.append(hook)
+    return hook
+
+
+def hook_signal(signal, callback, data):
+    return _hook('signal', signal, callback, data)
+
+
+def hook_modifier(modifier, callback, data):
+    return _hook('modifier', modifier, callback, data)
+
+
+def hook_config(option, callback, data):
+    return _hook('config', option, callback, data)
+
+
+def hook_command(command, description, args, args_description, completion,
+                 callback, data):
+    return _hook('command', command, callback, data)
+
+
+def hook_completion(completion, description, callback, data):
+    return _hook('completion', completion, callback, data)
+
+
+def hook_completion_list_add(completion, word, nick_completion, where):
+    pass
+
+
+def hook_timer(interval, align_second, max_calls, callback, data):
+    return _hook('timer', "", callback, data,
+                 interval=interval,
+                 remaining=max_calls,
+                 due=clock_ms + interval)
+
+
+def hook_process(command, timeout, callback, data):
+    return _hook('process', command, callback, data)
+
+
+def unhook(hook):
+    try:
+        hooks.remove(hook)
+    except ValueError:
+        pass
+
+
+def unhook_all():
+    del hooks[:]
+
+
+def _matching(kind, name):
+    return [hook for hook in hooks
+            if hook.kind == kind and fnmatch.fnmatchcase(name, hook.name)]
+
+
+def send_signal(signal, signal_data, callback_wrapper=None):
+    """Call the signal hooks matching signal, as hook_signal_send does."""
+    for hook in _matching('signal', signal):
+        call = callback_wrapper or _invoke
+        call(hook, hook.data, signal, signal_data)
+    return WEECHAT_RC_OK
+
+
+hook_signal_send = send_signal
+
+
+def run_modifier(modifier, modifier_data, string, callback_wrapper=None):
+    """Pass string through the modifier hooks, as hook_modifier_exec does."""
+    for hook in _matching('modifier', modifier):
+        call = callback_wrapper or _invoke
+        string = call(hook, hook.data, modifier, modifier_data, string)
+        if not string:
+            break
+    return string
+
+
+hook_modifier_exec = run_modifier
+
+
+def run_command(buffer, command_line):
+    """Call the hook_command callback for a /command line."""
+    (name, _, args) = command_line.lstrip('/').partition(' ')
+    for hook in _matching('command', name):
+        _invoke(hook, hook.data, buffer, args)
+        return WEECHAT_RC_OK
+    commands.append((buffer, command_line))
+    return WEECHAT_RC_OK
+
+
+def command(buffer, command_line):
+    return run_command(buffer, command_line)
+
+
+def _invoke(hook, *args):
+    hook.calls += 1
+    return hook.callback(*args)
+
+
+# Timers run on a virtual millisecond clock advanced by the caller.
+
+clock_ms = 0
+
+
+def advance_clock(milliseconds, callback_wrapper=None):
+    """Move the virtual clock forward, running timers as they fall due."""
+    global clock_ms
+    target = clock_ms + milliseconds
+
+    while True:
+        timers = [hook for hook in hooks
+                  if hook.kind == 'timer' and hook.due <= target]
+        if not timers:
+            break
+
+        timer = min(timers, key=lambda hook: hook.due)
+        clock_ms = max(clock_ms, timer.due)
+        timer.due = clock_ms + max(timer.interval, 1)
+
+        if timer.remaining > 0:
+            timer.remaining -= 1
+            remaining = timer.remaining
+            if remaining == 0:
+                unhook(timer)
+        else:
+            remaining = -1
+
+        call = callback_wrapper or _invoke
+        call(timer, timer.data, remaining)
+
+    clock_ms = target
+
+
+# Buffers and windows
+
+buffers = {}
+current_buffer_pointer = "core.weechat"
+window_title = None
+title_writes = 0
+
+
+def add_buffer(pointer, **properties):
+    """Create a buffer with the given string properties."""
+    properties.setdefault('name', pointer)
+    properties.setdefault('short_name', properties['name'])
+    buffers[pointer] = properties
+    return pointer
+
+
+add_buffer(current_buffer_pointer, name="weechat", short_name="weechat")
+
+
+def current_buffer():
+    return current_buffer_pointer
+
+
+def buffer_get_string(buffer, name):
+    return buffers.get(buffer, {}).get(name, "")
+
+
+def buffer_get_integer(buffer, name):
+    return int(buffers.get(buffer, {}).get(name, 0))
+
+
+def buffer_search(plugin, name):
+    for pointer, properties in buffers.items():
+        if properties.get('name') == name:
+            return pointer
+    return ""
+
+
+def window_set_title(title):
+    global window_title, title_writes
+    window_title = title
+    title_writes += 1
+
+
+# Hdata, only what is registered with set_hdata()
+
+hdata_fields = {}
+
+
+def set_hdata(name, field, func):
+    """Make hdata_*(hdata_get(name), pointer, field) return func(pointer)."""
+    hdata_fields[(name, field)] = func
+
+
+def hdata_get(name):
+    return name
+
+
+def _hdata(hdata, pointer, name):
+    try:
+        return hdata_fields[(hdata, name)](pointer)
+    except KeyError:
+        return None
+
+
+def hdata_pointer(hdata, pointer, name):
+    return _hdata(hdata, pointer, name) or ""
+
+
+def hdata_integer(hdata, pointer, name):
+    return int(_hdata(hdata, pointer, name) or 0)
+
+
+def hdata_string(hdata, pointer, name):
+    return _hdata(hdata, pointer, name) or ""
+
+
+# Plugin config, plugins.var.python.<script>.<option>
+
+plugin_config = {}
+
+
+def _plugin_option(name):
+    return "plugins.var.python.{script}.{name}".format(
+        script=_script_name, name=name)
+
+
+def config_get_plugin(name):
+    return plugin_config.get(_plugin_option(name), "")
+
+
+def config_is_set_plugin(name):
+    return 1 if _plugin_option(name) in plugin_config else 0
+
+
+def config_set_plugin(name, value):
+    return set_plugin_option(_plugin_option(name), value)
+
+
+def set_plugin_option(option, value):
+    """Set a plugins.var option and run the hook_config callbacks."""
+    old = plugin_config.get(option)
+    plugin_config[option] = value
+    if old == value:
+        return WEECHAT_CONFIG_OPTION_SET_OK_SAME_VALUE
+    for hook in _matching('config', option):
+        _invoke(hook, hook.data, option, value)
+    return WEECHAT_CONFIG_OPTION_SET_OK_CHANGED
+
+
+def config_get(option):
+    return option
+
+
+# Config files
+
+class _ConfigFile(object):
+    def __init__(self, name, reload_cb, reload_cb_data):
+        self.name = name
+        self.reload_cb = _Callback(reload_cb)
+        self.reload_cb_data = reload_cb_data
+        self.sections = {}
+
+
+class _ConfigSection(object):
+    def __init__(self, config_file, name):
+        self.config_file = config_file
+        self.name = name
+        self.options = {}
+
+
+class _ConfigOption(object):
+    def __init__(self, section, name, option_type, default, change_cb,
+                 change_data):
+        self.section = section
+        self.name = name
+        self.type = option_type
+        self.value = default
+        self.change_cb = _Callback(change_cb)
+        self.change_data = change_data
+
+
+def config_new(name, reload_cb, reload_cb_data):
+    return _ConfigFile(name, reload_cb, reload_cb_data)
+
+
+def config_new_section(config_file, name, *args):
+    section = _ConfigSection(config_file, name)
+    config_file.sections[name] = section
+    return section
+
+
+def config_new_option(config_file, section, name, option_type, desc,
+                      string_values, min_value, max_value, default, value,
+                      null_value_allowed, check_cb, check_cb_data,
+                      change_cb, change_cb_data, delete_cb, delete_cb_data):
+    option = _ConfigOption(section, name, option_type, value, change_cb,
+                           change_cb_data)
+    section.options[name] = option
+    return option
+
+
+def config_free(config_file):
+    pass
+
+
+def config_read(config_file):
+    return WEECHAT_CONFIG_READ_OK
+
+
+def config_reload(config_file):
+    return WEECHAT_CONFIG_READ_OK
+
+
+def config_write(config_file):
+    return 0
+
+
+def config_search_section(config_file, name):
+    return config_file.sections.get(name, "")
+
+
+def config_search_option(config_file, section, name):
+    return section.options.get(name, "")
+
+
+def config_option_set(option, value, run_callback):
+    if option.value == value:
+        return WEECHAT_CONFIG_OPTION_SET_OK_SAME_VALUE
+    option.value = value
+    if run_callback:
+        option.change_cb(option.change_data, option)
+    return WEECHAT_CONFIG_OPTION_SET_OK_CHANGED
+
+
+def config_boolean(option):
+    return 1 if option.value in ("on", "yes", "true", "1", 1, True) else 0
+
+
+def config_integer(option):
+    return int(option.value)
+
+
+def config_string(option):
+    return option.value
+
+
+def config_color(option):
+    return option.value
+
+
+# Infolists
+
+_infolists = {}
+
+
+class _Infolist(object):
+    def __init__(self, rows):
+        self.rows = rows
+        self.index = -1
+
+    def current(self):
+        return self.rows[self.index]
+
+
+def set_infolist(name, rows):
+    """Set the rows returned by infolist_get(name, ...).
+
+    rows is a list of dicts, or a function called with (pointer, args)
+    that returns one. Values of type int are reported as 'i', everything
+    else as 's'.
+    """
+    _infolists[name] = rows
+
+
+def infolist_get(name, pointer, args):
+    rows = _infolists.get(name)
+    if rows is None:
+        return ""
+    if callable(rows):
+        rows = rows(pointer, args)
+    return _Infolist(rows)
+
+
+def infolist_next(infolist):
+    if not infolist:
+        return 0
+    infolist.index += 1
+    return 1 if infolist.index < len(infolist.rows) else 0
+
+
+def infolist_fields(infolist):
+    return ",".join(
+        "{type}:{name}".format(
+            type='i' if isinstance(value, int) else 's',
+            name=name)
+        for name, value in infolist.current().items())
+
+
+def infolist_integer(infolist, name):
+    return int(infolist.current().get(name, 0))
+
+
+def infolist_string(infolist, name):
+    return infolist.current().get(name, "")
+
+
+def infolist_pointer(infolist, name):
+    return infolist.current().get(name, "")
+
+
+def infolist_time(infolist, name):
+    return infolist.current().get(name, 0)
+
+
+def infolist_free(infolist):
+    pass
@@ -0,0 +1,156 @@
+"""
+Signal invalidated snapshots of commonly used infolists.
+
+A script that walks the same infolists several times per event can use
+cached_infolist() in place of infolist_generator to avoid going through
+infolist_get every time. WeeChat runs each Python script in its own
+interpreter, so every script that imports this module has its own
+snapshots and hooks; nothing is shared between scripts.
+
+    from infolist_cache import cached_infolist
+
+    for row in cached_infolist("hotlist"):
+        ...
+
+Snapshots are keyed by (name, pointer, args). They're dropped when one of
+the signals that can change them fires, or once they're older than
+MAX_AGE seconds. Some fields change without any signal, such as the
+irc_server lag or irc_nick away flags on servers without away-notify, so
+those can be up to MAX_AGE seconds out of date. Don't use the cache where
+that matters. The returned rows are shared between callers and must not
+be modified.
+"""
+try:
+    import weechat
+except ImportError:
+    import sys
+    print("You must run this inside weechat")
+    sys.exit(1)
+import time
+
+from infolist_generator import infolist_generator
+
+# Seconds after which a snapshot is refetched even if no signal fired.
+MAX_AGE = 5
+
+# Infolists we cache and the signals that invalidate them.
+INVALIDATING_SIGNALS = {
+    'irc_server': (
+        "irc_server_connecting",
+        "irc_server_connected",
+        "irc_server_disconnected",
+        "*,irc_in2_nick",
+        "*,irc_in2_305",
+        "*,irc_in2_306",
+    ),
+    'irc_channel': (
+        "irc_channel_opened",
+        "irc_pv_opened",
+        "buffer_closed",
+        "*,irc_in2_join",
+        "*,irc_in2_part",
+        "*,irc_in2_kick",
+        "*,irc_in2_nick",
+        "*,irc_in2_topic",
+        "*,irc_in2_mode",
+    ),
+    'irc_nick': (
+        "buffer_closed",
+        "*,irc_in2_join",
+        "*,irc_in2_part",
+        "*,irc_in2_kick",
+        "*,irc_in2_quit",
+        "*,irc_in2_nick",
+        "*,irc_in2_mode",
+        "*,irc_in2_353",
+        "*,irc_in2_366",
+        "*,irc_in2_away",
+        "*,irc_in2_chghost",
+        "*,irc_in2_account",
+    ),
+    'hotlist': (
+        "hotlist_changed",
+        "buffer_moved",
+        "buffer_merged",
+        "buffer_unmerged",
+        "buffer_closed",
+    ),
+}
+
+_snapshots = {}
+_hooks = []
+
+
+def _install_hooks():
+    """Hook the invalidating signals on first use."""
+    # WeeChat looks callbacks up by name in the script's main module, so
+    # make ours visible there.
+    import __main__
+    __main__.infolist_cache_signal_cb = infolist_cache_signal_cb
+
+    signals = {}
+    for name, names_signals in INVALIDATING_SIGNALS.items():
+        for signal in names_signals:
+            signals.setdefault(signal, []).append(name)
+
+    for signal, names in signals.items():
+        _hooks.append(weechat.hook_signal(
+            signal,
+            "infolist_cache_signal_cb",
+            ",".join(names)))
+
+
+def infolist_cache_signal_cb(userdata, signal, signal_data):
+    """Drop the snapshots of the infolists given in userdata."""
+    for name in userdata.split(","):
+        invalidate(name)
+    return weechat.WEECHAT_RC_OK
+
+
+def invalidate(infolist_name=None):
+    """Drop cached snapshots of infolist_name, or all of them."""
+    if infolist_name is None:
+        _snapshots.clear()
+        return
+
+    for key in [k for k in _snapshots if k[0] == infolist_name]:
+        del _snapshots[key]
+
+
+def cached_infolist(infolist_name, pointer="", infolist_args=""):
+    """Return the rows of an infolist as a list of dicts.
+
+    The rows are the same as iterating over infolist_generator with the
+    same arguments. Infolists that aren't in INVALIDATING_SIGNALS are
+    fetched every time.
+    """
+    if infolist_name not in INVALIDATING_SIGNALS:
+        with infolist_generator(
+                infolist_name, pointer, infolist_args) as infolist:
+            return list(infolist)
+
+    if not _hooks:
+        _install_hooks()
+
+    key = (infolist_name, pointer, infolist_args)
+    now = time.time()
+
+    try:
+        (fetched, rows) = _snapshots[key]
+        if now - fetched < MAX_AGE:
+            return rows
+    except KeyError:
+        pass
+
+    with infolist_generator(infolist_name, pointer, infolist_args) as infolist:
+        rows = list(infolist)
+
+    _snapshots[key] = (now, rows)
+    return rows
+
+
+def unhook():
+    """Remove our signal hooks and drop all snapshots."""
+    while _hooks:
+        weechat.unhook(_hooks.pop())
+    invalidate()
@@ -1,3 +1,10 @@
+try:
+    import weechat
+except ImportError:
+    import sys
+    print("You must run this inside weechat")
+    sys.exit(1)
+
 FIELD_TYPES = {
         # Not available to API
         #'b': "infolist_buffer",
@@ -7,12 +14,20 @@ FIELD_TYPES = {
         't': "infolist_time",
         }
 
+def infolist_missing(infolist, name):
+    # Value for fields that don't exist or can't be read.
+    return None
+
 class infolist_generator(object):
-    def __init__(self, infolist_name, pointer, infolist_args):
+    def __init__(self, infolist_name, pointer, infolist_args, columns=None):
         self.infolist_name = infolist_name
         self.pointer = pointer
         self.infolist_args = infolist_args
+        # Optional list of field names to restrict extraction to.
+        self.columns = columns
         self._infolist = None
+        self._types = None
+        self._schema = None
 
     def __enter__(self):
         self._infolist = weechat.infolist_get(
@@ -37,9 +52,10 @@ class infolist_generator(object):
         else:
             raise StopIteration
 
-    def get_fields(self):
-        fields = {}
-        try:
+    def get_types(self):
+        # Field types are parsed once, the first time we're on a row.
+        if self._types is None:
+            self._types = {}
             for field in weechat.infolist_fields(self._infolist).split(","):
                 (field_type, field_name) = field.split(":")
                 infolist_function = FIELD_TYPES.get(field_type, None)
@@ -48,14 +64,52 @@ class infolist_generator(object):
                 if infolist_function is None:
                     continue
 
-                field_value = getattr(weechat, infolist_function)(
-                        self._infolist, field_name
-                        )
-                fields[field_name] = field_value
-            return fields
+                self._types[field_name] = getattr(weechat, infolist_function)
+        return self._types
+
+    def get_schema(self):
+        # List of (name, function) for the fields we want to extract.
+        if self._schema is None:
+            types = self.get_types()
+            names = self.columns if self.columns is not None else types
+            self._schema = [
+                    (name, types.get(name, infolist_missing))
+                    for name in names
+                    ]
+        return self._schema
+
+    def get_fields(self):
+        try:
+            infolist = self._infolist
+            return {
+                    name: func(infolist, name)
+                    for (name, func) in self.get_schema()
+                    }
         except TypeError as e:
             weechat.prnt("", "Exception: {}".format(e))
 
+    def to_rows(self):
+        # Remaining rows as a list of tuples, in column order.
+        infolist = self._infolist
+        rows = []
+        while weechat.infolist_next(infolist):
+            rows.append(tuple(
+                func(infolist, name)
+                for (name, func) in self.get_schema()
+                ))
+        return rows
+
+    def column(self, name):
+        # Values of a single field from the remaining rows.
+        infolist = self._infolist
+        values = []
+        func = None
+        while weechat.infolist_next(infolist):
+            if func is None:
+                func = self.get_types().get(name, infolist_missing)
+            values.append(func(infolist, name))
+        return values
+
     def next(self):
         # Python 2 compatibility
         return self.__next__()
@@ -79,6 +133,11 @@ class infolist_generator(object):
 #    with infolist_generator("irc_nick", "", "{server},{channel}".format(
 #        server=server,
 #        channel=channel)) as infolist:
-#        nicks = [row['name'] for row in infolist]
+#        nicks = infolist.column('name')
 #
 #    return nicks
+
+# def get_hotlist():
+#    with infolist_generator("hotlist", "", "",
+#            columns=("buffer_number", "priority")) as infolist:
+#        return infolist.to_rows()
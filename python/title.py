@@ -22,6 +22,16 @@
 # (this script requires WeeChat 0.3.0 or newer)
 #
 # History:
+# 2026-10-18, phyber
+#     version 0.8, title_format option with $N, $S, $B and $H expandos,
+#     compiled once and rendered from cached values
+# 2026-10-18, phyber
+#     version 0.7, coalesce bursts of title updates with a short timer and
+#     don't rewrite an unchanged title
+# 2026-10-18, phyber
+#     version 0.6, keep an in-memory hotlist updated from signals instead of
+#     rescanning the hotlist infolist on every signal that doesn't change
+#     it
 # 2012-12-09, WakiMiko
 #     version 0.5, update title when switching window (for WeeChat >= 0.3.7)
 # 2009-06-18, xt
@@ -33,11 +43,13 @@
 # 2009-05-10, xt <xt@bash.no>
 #     version 0.1: initial release
 
+from collections import OrderedDict
+
 import weechat as w
 
 SCRIPT_NAME    = "title"
 SCRIPT_AUTHOR  = "xt <xt@bash.no>"
-SCRIPT_VERSION = "0.5"
+SCRIPT_VERSION = "0.8"
 SCRIPT_LICENSE = "GPL3"
 SCRIPT_DESC    = "Set screen title to current buffer name + hotlist items with configurable priority level"
 
@@ -45,47 +57,249 @@ SCRIPT_DESC    = "Set screen title to current buffer name + hotlist items with c
 settings = {
     "title_priority"       : '2',
     "short_name"           : 'on',
+    "title_delay"          : '100',
+    "title_format"         : '$B $H',
 }
 
+# signal -> callback
 hooks = (
-        'buffer_switch',
-        'window_switch',
-        'hotlist_*',
+        ('buffer_switch', 'update_title'),
+        ('window_switch', 'update_title'),
+        ('hotlist_changed', 'hotlist_changed_cb'),
+        ('buffer_renamed', 'buffer_changed_cb'),
+        ('buffer_moved', 'buffers_renumbered_cb'),
+        ('buffer_merged', 'buffers_renumbered_cb'),
+        ('buffer_unmerged', 'buffers_renumbered_cb'),
+        ('buffer_closed', 'buffer_closed_cb'),
+        ('*,irc_in2_nick', 'nick_changed_cb'),
 )
 
+# In-memory copy of the hotlist, buffer pointer -> priority, in hotlist order
+hotlist = OrderedDict()
+
+# Cached buffer properties, buffer pointer -> (number, name, short_name)
+buffer_info = {}
+
+# Cached plugin options
+options = {}
+
+# title_format compiled to a list of functions returning each segment
+title_segments = []
+
+# Cached expando values, expando -> string
+expando_values = {}
+
+# The title last written to the terminal
+last_title = None
+
+# Pending delayed title update
+title_timer = None
+
+def current_nickname():
+    ''' $N: our nick on the current buffer's server. '''
+    return w.buffer_get_string(w.current_buffer(), 'localvar_nick')
+
+def current_server():
+    ''' $S: the current buffer's server. '''
+    return w.buffer_get_string(w.current_buffer(), 'localvar_server')
+
+def current_buffer_name():
+    ''' $B: the current buffer's name, or short name. '''
+    (number, name, short_name) = get_buffer_info(w.current_buffer())
+    if options['short_name']:
+        return short_name
+    return name
+
+def hotlist_items():
+    ''' $H: number:short_name of the hotlist buffers at title_priority. '''
+    title_priority = options['title_priority']
+    return ' '.join('%s:%s' % get_buffer_info(thebuffer)[0:3:2]
+                    for thebuffer, priority in hotlist.items()
+                    if priority >= title_priority)
+
 expandos = {
-		'$N': current_nickname,
+        '$N': current_nickname,
+        '$S': current_server,
+        '$B': current_buffer_name,
+        '$H': hotlist_items,
+}
 
-		}
+def compile_format(title_format):
+    ''' Compile a title format into a list of segment functions. '''
+    segments = []
+    literal = ''
+    i = 0
+    while i < len(title_format):
+        expando = title_format[i:i + 2]
+        if expando in expandos:
+            if literal:
+                segments.append(lambda text=literal: text)
+                literal = ''
+            segments.append(lambda expando=expando: expando_value(expando))
+            i += 2
+        elif expando == '$$':
+            literal += '$'
+            i += 2
+        else:
+            literal += title_format[i]
+            i += 1
+    if literal:
+        segments.append(lambda text=literal: text)
+    return segments
 
-def update_title(data, signal, signal_data):
-    ''' The callback that adds title. '''
+def expando_value(expando):
+    ''' Return the value of an expando, cached until invalidated. '''
+    try:
+        return expando_values[expando]
+    except KeyError:
+        value = expando_values[expando] = expandos[expando]()
+        return value
+
+def invalidate(*names):
+    ''' Forget the cached values of expandos. '''
+    for expando in names:
+        expando_values.pop(expando, None)
+
+def load_options():
+    ''' Read the plugin options into the cache. '''
+    global title_segments
+    try:
+        options['title_priority'] = int(w.config_get_plugin('title_priority'))
+    except ValueError:
+        options['title_priority'] = int(settings['title_priority'])
+    options['short_name'] = w.config_get_plugin('short_name') == 'on'
+    try:
+        options['title_delay'] = int(w.config_get_plugin('title_delay'))
+    except ValueError:
+        options['title_delay'] = int(settings['title_delay'])
+    title_segments = compile_format(w.config_get_plugin('title_format'))
+    expando_values.clear()
 
-    if w.config_get_plugin('short_name') == 'on':
-        title = w.buffer_get_string(w.current_buffer(), 'short_name')
+def config_cb(data, option, value):
+    ''' An option changed, reload them and redraw. '''
+    load_options()
+    return schedule_title()
+
+def get_buffer_info(buffer):
+    ''' Return (number, name, short_name) for a buffer, cached. '''
+    try:
+        return buffer_info[buffer]
+    except KeyError:
+        info = (w.buffer_get_integer(buffer, 'number'),
+                w.buffer_get_string(buffer, 'name'),
+                w.buffer_get_string(buffer, 'short_name'))
+        buffer_info[buffer] = info
+        return info
+
+def buffer_hotlist_priority(buffer):
+    ''' Return the hotlist priority of a buffer, or None if it's not in it. '''
+    pointer = w.hdata_pointer(w.hdata_get('buffer'), buffer, 'hotlist')
+    if not pointer:
+        return None
+    return w.hdata_integer(w.hdata_get('hotlist'), pointer, 'priority')
+
+def rescan_hotlist():
+    ''' Rebuild the hotlist model from the hotlist infolist. '''
+    hotlist.clear()
+    infolist = w.infolist_get('hotlist', '', '')
+    while w.infolist_next(infolist):
+        thebuffer = w.infolist_pointer(infolist, 'buffer_pointer')
+        hotlist[thebuffer] = w.infolist_integer(infolist, 'priority')
+    w.infolist_free(infolist)
+    invalidate('$H')
+
+def hotlist_changed_cb(data, signal, signal_data):
+    ''' Update the hotlist model for the buffer that changed. '''
+    if not signal_data:
+        # No buffer given, anything could have changed.
+        rescan_hotlist()
     else:
-        title = w.buffer_get_string(w.current_buffer(), 'name')
+        priority = buffer_hotlist_priority(signal_data)
+        if priority is None:
+            # Dropping a buffer doesn't change the order of the others.
+            if hotlist.pop(signal_data, None) is None:
+                return w.WEECHAT_RC_OK
+            invalidate('$H')
+        elif hotlist.get(signal_data) == priority:
+            return w.WEECHAT_RC_OK
+        else:
+            # WeeChat sorts a new or raised buffer into the hotlist by
+            # weechat.look.hotlist_sort, so take its order from there.
+            rescan_hotlist()
+    return schedule_title()
+
+def buffer_changed_cb(data, signal, signal_data):
+    ''' A buffer was renamed, forget its cached properties. '''
+    buffer_info.pop(signal_data, None)
+    invalidate('$B', '$H')
+    return schedule_title()
+
+def buffers_renumbered_cb(data, signal, signal_data):
+    ''' Buffer numbers changed, forget all cached properties. '''
+    buffer_info.clear()
+    invalidate('$B', '$H')
+    return schedule_title()
+
+def buffer_closed_cb(data, signal, signal_data):
+    ''' A buffer was closed, forget it. '''
+    hotlist.pop(signal_data, None)
+    return buffers_renumbered_cb(data, signal, signal_data)
+
+def nick_changed_cb(data, signal, signal_data):
+    ''' Someone changed nick, redraw if it was us. '''
+    nick = signal_data.lstrip(':').split('!', 1)[0]
+    if '$N' in expando_values and nick == expando_values['$N']:
+        invalidate('$N')
+        return schedule_title()
+    return w.WEECHAT_RC_OK
+
+def update_title(data, signal, signal_data):
+    ''' The callback that adds title, right away. '''
+    global title_timer
+    if title_timer:
+        w.unhook(title_timer)
+        title_timer = None
+    invalidate('$N', '$S', '$B')
+    return refresh_title()
+
+def schedule_title():
+    ''' Update the title after title_delay ms, coalescing bursts. '''
+    global title_timer
+    if options['title_delay'] <= 0:
+        return refresh_title()
+    if not title_timer:
+        title_timer = w.hook_timer(options['title_delay'], 0, 1,
+                                   'title_timer_cb', '')
+    return w.WEECHAT_RC_OK
+
+def title_timer_cb(data, remaining_calls):
+    ''' The delayed title update. '''
+    global title_timer
+    title_timer = None
+    return refresh_title()
+
+def refresh_title():
+    ''' Set the title if it has changed. '''
+    global last_title
 
-    hotlist = w.infolist_get('hotlist', '', '')
-    while w.infolist_next(hotlist):
-        priority = w.infolist_integer(hotlist, 'priority')
-        if priority >= int(w.config_get_plugin('title_priority')):
-            number = w.infolist_integer(hotlist, 'buffer_number')
-            thebuffer = w.infolist_pointer(hotlist, 'buffer_pointer')
-            name = w.buffer_get_string(thebuffer, 'short_name')
+    title = ''.join([segment() for segment in title_segments]).rstrip()
 
-            title += ' %s:%s' % (number, name)
-    w.infolist_free(hotlist)
+    if title == last_title:
+        return w.WEECHAT_RC_OK
+    last_title = title
 
     w.window_set_title(title)
 
     return w.WEECHAT_RC_OK
 
 if w.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION, SCRIPT_LICENSE, SCRIPT_DESC, "", ""):
-    for option, default_value in settings.iteritems():
+    for option, default_value in settings.items():
         if not w.config_is_set_plugin(option):
             w.config_set_plugin(option, default_value)
-    for hook in hooks:
-        w.hook_signal(hook, 'update_title', '')
+    load_options()
+    for (hook, callback) in hooks:
+        w.hook_signal(hook, callback, '')
+    w.hook_config('plugins.var.python.%s.*' % SCRIPT_NAME, 'config_cb', '')
 
-    update_title('', '', '')
+    rescan_hotlist()
+    refresh_title()
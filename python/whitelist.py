@@ -4,11 +4,28 @@ except ImportError:
     import sys
     print("This script must be run under WeeChat")
     sys.exit(1)
+import bisect
+import cProfile
+import os
 import re
 import time
+from collections import OrderedDict, deque
+
+# Python 3.3 and later, without it IP ranges are matched as globs.
+try:
+    import ipaddress
+except ImportError:
+    ipaddress = None
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 
 # The minimum WeeChat version that we require, in hex.
 WEECHAT_VERSION_HEX_1_3_0 = 0x01030000
+# hook_process("func:...") for quarantine compaction needs this version.
+WEECHAT_VERSION_HEX_1_5_0 = 0x01050000
 
 SCRIPT_NAME = "whitelist"
 SCRIPT_AUTHOR = "phyber"
@@ -46,6 +63,106 @@ SCRIPT_CONFIG = {
             "change_data":   "",
             "delete_cb":     "",
         },
+        'flood_burst': {
+            "type":          "integer",
+            "desc":          "Number of blocked messages accepted from a "
+                             "host before further messages are dropped "
+                             "unchecked (0 disables flood protection)",
+            "min":           0,
+            "max":           10000,
+            "string_values": "",
+            "default":       "5",
+            "value":         "5",
+            "check_cb":      "",
+            "change_cb":     "whitelist_flood_option_change_cb",
+            "change_data":   "flood_burst",
+            "delete_cb":     "",
+        },
+        'flood_rate': {
+            "type":          "integer",
+            "desc":          "Number of blocked messages per minute a "
+                             "host is allowed once its burst is used up",
+            "min":           0,
+            "max":           10000,
+            "string_values": "",
+            "default":       "10",
+            "value":         "10",
+            "check_cb":      "",
+            "change_cb":     "whitelist_flood_option_change_cb",
+            "change_data":   "flood_rate",
+            "delete_cb":     "",
+        },
+        'timing': {
+            "type":          "boolean",
+            "desc":          "Time each stage of the whitelist check, "
+                             "shown by /whitelist stats",
+            "min":           0,
+            "max":           0,
+            "string_values": "",
+            "default":       "off",
+            "value":         "off",
+            "check_cb":      "",
+            "change_cb":     "whitelist_timing_option_change_cb",
+            "change_data":   "timing",
+            "delete_cb":     "",
+        },
+        'notification_interval': {
+            "type":          "integer",
+            "desc":          "Coalesce blocked message notifications into "
+                             "one summary line every this many seconds "
+                             "(0 notifies for every message)",
+            "min":           0,
+            "max":           3600,
+            "string_values": "",
+            "default":       "0",
+            "value":         "0",
+            "check_cb":      "",
+            "change_cb":     "whitelist_flood_option_change_cb",
+            "change_data":   "notification_interval",
+            "delete_cb":     "",
+        },
+        'log_flush_interval': {
+            "type":          "integer",
+            "desc":          "Number of milliseconds to buffer blocked "
+                             "message log lines before writing them",
+            "min":           0,
+            "max":           60000,
+            "string_values": "",
+            "default":       "1000",
+            "value":         "1000",
+            "check_cb":      "",
+            "change_cb":     "whitelist_log_option_change_cb",
+            "change_data":   "log_flush_interval",
+            "delete_cb":     "",
+        },
+        'log_max_lines': {
+            "type":          "integer",
+            "desc":          "Maximum number of log lines to buffer, the "
+                             "buffer is written out when this is reached",
+            "min":           1,
+            "max":           100000,
+            "string_values": "",
+            "default":       "1000",
+            "value":         "1000",
+            "check_cb":      "",
+            "change_cb":     "whitelist_log_option_change_cb",
+            "change_data":   "log_max_lines",
+            "delete_cb":     "",
+        },
+        'log_rotate_size': {
+            "type":          "integer",
+            "desc":          "Rotate the log file when it grows past this "
+                             "many kilobytes (0 disables rotation)",
+            "min":           0,
+            "max":           1048576,
+            "string_values": "",
+            "default":       "0",
+            "value":         "0",
+            "check_cb":      "",
+            "change_cb":     "whitelist_log_option_change_cb",
+            "change_data":   "log_rotate_size",
+            "delete_cb":     "",
+        },
         'network_channel_only': {
             "type":          "boolean",
             "desc":          "Only allow messages from a person if they're "
@@ -57,8 +174,140 @@ SCRIPT_CONFIG = {
             "default":       "on",
             "value":         "on",
             "check_cb":      "",
-            "change_cb":     "",
-            "change_data":   "",
+            "change_cb":     "whitelist_verdict_option_change_cb",
+            "change_data":   "network_channel_only",
+            "delete_cb":     "",
+        },
+        'cache_size': {
+            "type":          "integer",
+            "desc":          "Maximum number of whitelist verdicts to cache "
+                             "(0 disables the cache)",
+            "min":           0,
+            "max":           1000000,
+            "string_values": "",
+            "default":       "1024",
+            "value":         "1024",
+            "check_cb":      "",
+            "change_cb":     "whitelist_cache_option_change_cb",
+            "change_data":   "cache_size",
+            "delete_cb":     "",
+        },
+        'database': {
+            "type":          "string",
+            "desc":          "SQLite database to keep the whitelists in, "
+                             "instead of the whitelists options, so they "
+                             "can be shared by several WeeChat instances "
+                             "(relative to the WeeChat directory, empty "
+                             "to use the options)",
+            "min":           0,
+            "max":           0,
+            "string_values": "",
+            "default":       "",
+            "value":         "",
+            "check_cb":      "",
+            "change_cb":     "whitelist_database_option_change_cb",
+            "change_data":   "database",
+            "delete_cb":     "",
+        },
+        'database_poll_interval': {
+            "type":          "integer",
+            "desc":          "Number of seconds between checks for changes "
+                             "made to the database by other WeeChat "
+                             "instances",
+            "min":           1,
+            "max":           3600,
+            "string_values": "",
+            "default":       "5",
+            "value":         "5",
+            "check_cb":      "",
+            "change_cb":     "whitelist_database_option_change_cb",
+            "change_data":   "database_poll_interval",
+            "delete_cb":     "",
+        },
+        'quarantine': {
+            "type":          "boolean",
+            "desc":          "Keep blocked private messages in a database "
+                             "that /whitelist blocked can search",
+            "min":           0,
+            "max":           0,
+            "string_values": "",
+            "default":       "on",
+            "value":         "on",
+            "check_cb":      "",
+            "change_cb":     "whitelist_quarantine_option_change_cb",
+            "change_data":   "quarantine",
+            "delete_cb":     "",
+        },
+        'quarantine_days': {
+            "type":          "integer",
+            "desc":          "Number of days to keep blocked messages for "
+                             "(0 keeps them forever, needs WeeChat >= 1.5)",
+            "min":           0,
+            "max":           36500,
+            "string_values": "",
+            "default":       "30",
+            "value":         "30",
+            "check_cb":      "",
+            "change_cb":     "whitelist_quarantine_option_change_cb",
+            "change_data":   "quarantine_days",
+            "delete_cb":     "",
+        },
+        'quarantine_max_messages': {
+            "type":          "integer",
+            "desc":          "Maximum number of blocked messages to keep, "
+                             "the oldest are deleted first (0 for no limit, "
+                             "needs WeeChat >= 1.5)",
+            "min":           0,
+            "max":           100000000,
+            "string_values": "",
+            "default":       "100000",
+            "value":         "100000",
+            "check_cb":      "",
+            "change_cb":     "whitelist_quarantine_option_change_cb",
+            "change_data":   "quarantine_max_messages",
+            "delete_cb":     "",
+        },
+        'hold_size': {
+            "type":          "integer",
+            "desc":          "Number of blocked messages to hold in memory "
+                             "for /whitelist accept, the oldest are dropped "
+                             "first (0 disables holding)",
+            "min":           0,
+            "max":           100000,
+            "string_values": "",
+            "default":       "200",
+            "value":         "200",
+            "check_cb":      "",
+            "change_cb":     "whitelist_hold_option_change_cb",
+            "change_data":   "hold_size",
+            "delete_cb":     "",
+        },
+        'hold_per_sender': {
+            "type":          "integer",
+            "desc":          "Maximum number of messages held from one "
+                             "sender, their oldest are dropped first",
+            "min":           1,
+            "max":           100000,
+            "string_values": "",
+            "default":       "10",
+            "value":         "10",
+            "check_cb":      "",
+            "change_cb":     "whitelist_hold_option_change_cb",
+            "change_data":   "hold_per_sender",
+            "delete_cb":     "",
+        },
+        'cache_ttl': {
+            "type":          "integer",
+            "desc":          "Number of seconds a cached whitelist verdict "
+                             "stays valid",
+            "min":           0,
+            "max":           86400,
+            "string_values": "",
+            "default":       "60",
+            "value":         "60",
+            "check_cb":      "",
+            "change_cb":     "whitelist_cache_option_change_cb",
+            "change_data":   "cache_ttl",
             "delete_cb":     "",
         },
     },
@@ -142,9 +391,53 @@ FIELD_TYPE_FUNC = {
 
 CTCP_MARKER = '\001'
 CHANNEL_PREFIX = ('#', '&')
+NICK_PREFIXES = "~&@%+!"
+
+# Seconds between summaries of flood dropped messages when notifications
+# aren't being coalesced.
+FLOOD_SUMMARY_INTERVAL = 10
+
+# Number of token buckets to keep before idle ones are pruned.
+FLOOD_MAX_BUCKETS = 10000
+
+# Stages of the whitelist check that can be timed, in display order.
+TIMING_STAGES = (
+    "parse",
+    "cache",
+    "server",
+    "nick",
+    "host",
+    "channel",
+    "notify",
+    "log",
+    "store",
+    "total",
+)
+
+# Seconds between compactions of the blocked message database.
+QUARANTINE_COMPACT_INTERVAL = 3600
+
+# Milliseconds a compaction may run for before it's killed.
+QUARANTINE_COMPACT_TIMEOUT = 300000
+
+# Number of blocked messages /whitelist blocked shows by default.
+QUARANTINE_DEFAULT_LIMIT = 20
+
+# Upper bounds of the latency histogram buckets, in microseconds.
+TIMING_BUCKETS = (1, 4, 16, 64, 256, 1024, 4096)
+
+# Signals used to keep the channel membership index up to date.
+MEMBERSHIP_SIGNALS = (
+    "*,irc_in2_join",
+    "*,irc_in2_part",
+    "*,irc_in2_kick",
+    "*,irc_in2_quit",
+    "*,irc_in2_nick",
+    "*,irc_in2_353",
+)
 
 # Host to RegEx mappings
-HTR = {x: x for x in (chr(x) for x in range(256))}
+HTR = {x: re.escape(x) for x in (chr(x) for x in range(256))}
 HTR['?'] = '.'
 HTR['*'] = '.*'
 
@@ -157,28 +450,76 @@ def host_to_lower(host):
         hostname=hostname.lower())
 
 
+def channel_to_lower(channel):
+    """Fold a channel name to lowercase, with the RFC 1459 casemapping.
+
+    This is WeeChat's default casemapping, so #Foo[1] and #foo{1} are the
+    same channel.
+    """
+    return (channel.lower().replace('[', '{').replace(']', '}')
+            .replace('\\', '|').replace('~', '^'))
+
+
+def glob_to_regex(pattern):
+    """Convert a glob pattern using * and ? to a regex."""
+    return "".join(HTR.get(char, re.escape(char)) for char in pattern)
+
+
 def host_to_regex(host):
     """Convert host to a regex."""
-    host = host_to_lower(host)
-    return re.sub('(.)', lambda match: HTR[match.group(0)], host)
+    return glob_to_regex(host_to_lower(host))
+
+
+def infolist_missing(infolist, name):
+    """Value for infolist fields that don't exist or can't be read."""
+    return None
+
+
+def split_irc_message(raw_irc_msg):
+    """Split a raw IRC line into a (source, command, params) tuple."""
+    # Drop IRCv3 message tags, we don't use them.
+    if raw_irc_msg.startswith('@'):
+        raw_irc_msg = raw_irc_msg.split(' ', 1)[1]
+
+    source = ""
+    if raw_irc_msg.startswith(':'):
+        (source, raw_irc_msg) = raw_irc_msg[1:].split(' ', 1)
+
+    if ' :' in raw_irc_msg:
+        (raw_irc_msg, trailing) = raw_irc_msg.split(' :', 1)
+        params = raw_irc_msg.split()
+        params.append(trailing)
+    else:
+        params = raw_irc_msg.split()
+
+    command = params.pop(0).upper() if params else ""
+    return (source, command, params)
 
 
 class InfolistGenerator(object):
     """Infolist context manager/generator for easy use of infolists.
 
-    Accepts the same arguments as weechat's infolist_get function.
+    Accepts the same arguments as weechat's infolist_get function, plus an
+    optional list of columns to restrict which fields are extracted. The
+    field types are only parsed once per infolist.
 
     >>> with InfolistGenerator("irc_channel", "", "server_name") as infolist:
     >>>     channels = [row['name']
     >>>         for row in infolist
     >>>         if row['name'].startswith('#')]
+
+    >>> with InfolistGenerator("irc_nick", "", "server,#chan") as infolist:
+    >>>     nicks = infolist.column('name')
     """
 
-    def __init__(self, infolist_name, pointer, infolist_args):
+    def __init__(self, infolist_name, pointer, infolist_args, columns=None):
         self.infolist_name = infolist_name
         self.pointer = pointer
         self.infolist_args = infolist_args
+        self.columns = columns
         self._infolist = None
+        self._types = None
+        self._schema = None
 
     def __enter__(self):
         self._infolist = weechat.infolist_get(
@@ -206,19 +547,36 @@ class InfolistGenerator(object):
         """Python 2 compat"""
         return self.__next__()
 
+    def _get_types(self):
+        """Return a dict of field name to infolist function."""
+        if self._types is None:
+            self._types = {}
+            for field in weechat.infolist_fields(self._infolist).split(","):
+                (field_type, field_name) = field.split(":")
+                try:
+                    self._types[field_name] = FIELD_TYPE_FUNC[field_type]
+                except KeyError:
+                    continue
+        return self._types
+
+    def _get_schema(self):
+        """Return a list of (name, function) for the fields to extract."""
+        if self._schema is None:
+            types = self._get_types()
+            names = self.columns if self.columns is not None else types
+            self._schema = [
+                (name, types.get(name, infolist_missing))
+                for name in names
+            ]
+        return self._schema
+
     def get_fields(self):
         """Return a dict of the fields in the current infolist position."""
-        fields = {}
-        for field in weechat.infolist_fields(self._infolist).split(","):
-            (field_type, field_name) = field.split(":")
-            try:
-                field_value = FIELD_TYPE_FUNC[field_type](
-                    self._infolist,
-                    field_name)
-            except KeyError:
-                continue
-            fields[field_name] = field_value
-        return fields
+        infolist = self._infolist
+        return {
+            name: func(infolist, name)
+            for (name, func) in self._get_schema()
+        }
 
     def get_field(self, field):
         """Return a single field from the info list"""
@@ -227,28 +585,83 @@ class InfolistGenerator(object):
         except KeyError:
             return None
 
+    def to_rows(self):
+        """Return the remaining rows as a list of tuples.
+
+        Values are in the order of columns, or infolist field order if no
+        columns were given.
+        """
+        infolist = self._infolist
+        rows = []
+        while weechat.infolist_next(infolist):
+            rows.append(tuple(
+                func(infolist, name)
+                for (name, func) in self._get_schema()))
+        return rows
+
+    def column(self, name):
+        """Return a list of the values of one field in the remaining rows."""
+        infolist = self._infolist
+        values = []
+        func = None
+        while weechat.infolist_next(infolist):
+            if func is None:
+                func = self._get_types().get(name, infolist_missing)
+            values.append(func(infolist, name))
+        return values
+
 
 class Message(object):
-    """Parse raw signal_data from WeeChat into something more managable."""
+    """Parse raw signal_data from WeeChat into something more managable.
+
+    Parsing is done in Python and only as far as needed. Checking whether
+    a message is for a channel only splits out the target, the sender and
+    text are only picked apart when they're asked for.
+    """
+    __slots__ = (
+        '_server',
+        '_signal_data',
+        '_source',
+        '_command',
+        '_channel',
+        '_arguments',
+    )
+
     def __init__(self, server, signal_data):
         self._server = server
         self._signal_data = signal_data
-        self.details = None
-        self._parse_message()
+        self._source = None
+        self._command = None
+        self._channel = None
+        self._arguments = None
 
     def __str__(self):
         return self.signal_data()
 
     def _parse_message(self):
-        """Parse the signal_data"""
-        self.details = weechat.info_get_hashtable("irc_message_parse", {
-            "message": self.signal_data(),
-            "server":  self.server()
-        })
+        """Split the signal_data into source, command and arguments."""
+        raw = self._signal_data
+
+        # Drop IRCv3 message tags, we don't use them.
+        if raw.startswith('@'):
+            raw = raw.split(' ', 1)[1]
+
+        source = ""
+        if raw.startswith(':'):
+            (source, _, raw) = raw[1:].partition(' ')
+
+        (command, _, arguments) = raw.partition(' ')
+
+        self._source = source
+        self._command = command.upper()
+        self._arguments = arguments
+        self._channel = arguments.partition(' ')[0]
 
     def arguments(self):
         """Return the command arguments"""
-        return self.details['arguments']
+        if self._arguments is None:
+            self._parse_message()
+        return self._arguments
 
     def channel(self):
         """
@@ -257,15 +670,21 @@ class Message(object):
         This might be better named "target", since it could be the
         nick of a user being queried.
         """
-        return self.details['channel']
+        if self._channel is None:
+            self._parse_message()
+        return self._channel
 
     def command(self):
         """Returns the IRC protocol command, eg. PRIVMSG."""
-        return self.details['command']
+        if self._command is None:
+            self._parse_message()
+        return self._command
 
     def host(self):
         """Return the host for the sender of the message"""
-        return self.details['host']
+        if self._source is None:
+            self._parse_message()
+        return self._source
 
     def hostname(self):
         """Return the hostname for the sender of the message"""
@@ -281,7 +700,7 @@ class Message(object):
 
     def nick(self):
         """Return the message sender nick"""
-        return self.details['nick']
+        return self.host().split('!', 1)[0]
 
     def server(self):
         """Return the server"""
@@ -293,7 +712,10 @@ class Message(object):
 
     def text(self):
         """Return the text"""
-        return self.details['text']
+        text = self.arguments().partition(' ')[2]
+        if text.startswith(':'):
+            return text[1:]
+        return text
 
     def is_action(self):
         """Return True if message is an action."""
@@ -331,11 +753,20 @@ class Message(object):
 
 
 class Config(object):
-    """Class for dealing with WeeChat configs."""
-    def __init__(self, config_name, reload_cb, reload_cb_data):
+    """Class for dealing with WeeChat configs.
+
+    Option pointers are looked up once at setup and values are cached.
+    Every option is created with change_cb, which must call refresh() for
+    the option so that the cache follows changes made with /set.
+    """
+    def __init__(self, config_name, reload_cb, reload_cb_data, change_cb):
         self._config_name = config_name
         self._reload_cb = reload_cb
         self._reload_cb_data = reload_cb_data
+        self._change_cb = change_cb
+        self._options = {}
+        self._readers = {}
+        self._values = {}
         self._config_file = self.setup_config_file()
 
     def setup_config_file(self):
@@ -360,7 +791,7 @@ class Config(object):
                 return None
 
             for option_name, props in SCRIPT_CONFIG[section].items():
-                weechat.config_new_option(
+                option = weechat.config_new_option(
                     config_file,
                     config_section,
                     option_name,
@@ -374,12 +805,22 @@ class Config(object):
                     0,
                     props['check_cb'],
                     "",
-                    props['change_cb'],
-                    props['change_data'],
+                    self._change_cb,
+                    "{section}.{option}".format(
+                        section=section,
+                        option=option_name),
                     props['delete_cb'],
                     ""
                 )
 
+                # Automatically choose the correct weechat.config_*
+                # function for reading the option.
+                key = (section, option_name)
+                self._options[key] = option
+                self._readers[key] = getattr(
+                    weechat,
+                    "config_{type}".format(type=props['type']))
+
         return config_file
 
     def is_ok(self):
@@ -396,60 +837,1600 @@ class Config(object):
 
     def get_value(self, section_name, option_name):
         """Return a value from the configuration."""
-        # This is a lot of work to just get the value of an option.
-        section = weechat.config_search_section(
-            self._config_file, section_name
-        )
-
-        option = weechat.config_search_option(
-            self._config_file, section, option_name
-        )
-
-        # Automatically choose the correct weechat.config_*
-        # function and call it.
-        config_function = "config_{type}".format(
-            type=SCRIPT_CONFIG[section_name][option_name]['type'])
+        try:
+            return self._values[(section_name, option_name)]
+        except KeyError:
+            return self.refresh(section_name, option_name)
 
-        value = getattr(weechat, config_function)(option)
+    def refresh(self, section_name, option_name):
+        """Read an option value into the cache and return it."""
+        key = (section_name, option_name)
+        value = self._readers[key](self._options[key])
+        self._values[key] = value
         return value
 
+    def refresh_all(self):
+        """Drop all cached values, they'll be read again on next use."""
+        self._values.clear()
+
     def set_value(self, section_name, option_name, value):
         """Set a configuration option."""
-        section = weechat.config_search_section(
-            self._config_file,
-            section_name)
+        option = self._options[(section_name, option_name)]
+        ret = weechat.config_option_set(option, value, 1)
+        return ret
 
-        option = weechat.config_search_option(
-            self._config_file,
-            section,
-            option_name)
 
-        ret = weechat.config_option_set(option, value, 1)
+class WhitelistEntries(object):
+    """The entries of each whitelist, kept as sets.
+
+    Adding or removing an entry only touches the set, the option value is
+    rebuilt from it when it's written back. While batching, option changes
+    don't rebuild the matcher or print the list, the batch does that once
+    when it's finished.
+    """
+    def __init__(self):
+        self._entries = {}
+        self.batching = False
+
+    def load(self, cfg, listtype=None):
+        """Load the entries of listtype, or every whitelist, from cfg."""
+        listtypes = [listtype] if listtype else SCRIPT_CONFIG['whitelists']
+        for name in listtypes:
+            self._entries[name] = set(
+                x for x in cfg.get_value('whitelists', name).split(" ") if x)
+
+    def replace(self, whitelists):
+        """Replace every whitelist with the sets in whitelists."""
+        self._entries = whitelists
+
+    def get(self, listtype):
+        """Return the set of entries for listtype."""
+        return self._entries.setdefault(listtype, set())
+
+    def add(self, listtype, value):
+        """Add value to listtype, False if it was already there."""
+        entries = self.get(listtype)
+        if value in entries:
+            return False
+        entries.add(value)
+        return True
+
+    def remove(self, listtype, value):
+        """Remove value from listtype, False if it wasn't there."""
+        entries = self.get(listtype)
+        if value not in entries:
+            return False
+        entries.remove(value)
+        return True
+
+    def value(self, listtype):
+        """Return the option value for listtype."""
+        # Sorted just so that output is nicer.
+        return " ".join(sorted(self.get(listtype)))
+
+    def save(self, cfg, listtype):
+        """Write the entries of listtype back to its option."""
+        return cfg.set_value('whitelists', listtype, self.value(listtype))
+
+
+class WhitelistStore(object):
+    """Whitelists kept in a SQLite database shared by WeeChat instances.
+
+    Each whitelist is a table keyed by its entries. Triggers count every
+    change in the whitelist_version table, so checking whether another
+    instance changed anything only reads that one row.
+    """
+    def __init__(self):
+        self.path = None
+        self.version = None
+        self._db = None
+        self._timer = None
+
+    @property
+    def enabled(self):
+        """True if the whitelists are kept in the database."""
+        return self._db is not None
+
+    def open(self, path, interval):
+        """Open or create the database, and poll it every interval seconds.
+
+        Raises sqlite3.Error if the database can't be used.
+        """
+        self.close()
+        db = sqlite3.connect(path, timeout=1)
+        try:
+            with db:
+                db.execute("CREATE TABLE IF NOT EXISTS whitelist_version "
+                           "(version INTEGER NOT NULL)")
+                if db.execute("SELECT COUNT(*) FROM whitelist_version"
+                              ).fetchone()[0] == 0:
+                    db.execute("INSERT INTO whitelist_version VALUES (0)")
+
+                for listtype in SCRIPT_CONFIG['whitelists']:
+                    db.execute("CREATE TABLE IF NOT EXISTS {table} "
+                               "(entry TEXT PRIMARY KEY) WITHOUT ROWID"
+                               .format(table=listtype))
+                    for event in ("INSERT", "DELETE"):
+                        db.execute(
+                            "CREATE TRIGGER IF NOT EXISTS {table}_{event} "
+                            "AFTER {event} ON {table} BEGIN "
+                            "UPDATE whitelist_version "
+                            "SET version = version + 1; END".format(
+                                table=listtype, event=event.lower()))
+        except sqlite3.Error:
+            db.close()
+            raise
+
+        self.path = path
+        self._db = db
+        self.version = None
+        self._timer = weechat.hook_timer(
+            interval * 1000, 0, 0, "whitelist_store_poll_cb", "")
+
+    def close(self):
+        """Stop polling and close the database."""
+        if self._timer is not None:
+            weechat.unhook(self._timer)
+            self._timer = None
+
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+        self.path = None
+        self.version = None
+
+    def _version(self):
+        """Return the database's change counter."""
+        return self._db.execute(
+            "SELECT version FROM whitelist_version").fetchone()[0]
+
+    def changed(self):
+        """Return True if the database changed since it was last loaded."""
+        return self._version() != self.version
+
+    def is_empty(self):
+        """Return True if there are no entries in any whitelist."""
+        for listtype in SCRIPT_CONFIG['whitelists']:
+            if self._db.execute("SELECT 1 FROM {table} LIMIT 1".format(
+                    table=listtype)).fetchone():
+                return False
+        return True
+
+    def load(self):
+        """Return every whitelist as a dict of sets."""
+        with self._db:
+            self.version = self._version()
+            return dict(
+                (listtype, set(row[0] for row in self._db.execute(
+                    "SELECT entry FROM {table}".format(table=listtype))))
+                for listtype in SCRIPT_CONFIG['whitelists'])
+
+    def update(self, listtype, added=(), removed=()):
+        """Add and remove entries of listtype in one transaction."""
+        with self._db:
+            current = self._version() == self.version
+            self._db.executemany(
+                "INSERT OR IGNORE INTO {table} VALUES (?)".format(
+                    table=listtype),
+                ((entry,) for entry in added))
+            self._db.executemany(
+                "DELETE FROM {table} WHERE entry = ?".format(table=listtype),
+                ((entry,) for entry in removed))
+            # Only skip the next reload if nobody else changed anything.
+            if current:
+                self.version = self._version()
+
+
+class HostIndex(object):
+    """Index of nick!user@host masks, looked up by the host part.
+
+    Most masks only have wildcards at the start or end of the host, so
+    rather than trying every mask in turn they are indexed by host:
+
+      - exact hosts, eg. *!*@host.example, in a dict
+      - *.isp.example in a trie keyed by the host's labels, last first
+      - prefixes ending in a /, like cloaks such as *!*@user/*, in a dict
+      - IP ranges, as CIDR (*!*@192.0.2.0/24) or octets (*!*@192.0.2.*),
+        in a dict per prefix length. Octet globs only match IP addresses,
+        not hostnames that happen to start with the same digits.
+
+    Only the masks found for a host have their nick!user part checked.
+    Anything else is put into a single regex, which is tried last.
+    """
+    # Matches any nick!user, so there's nothing to check.
+    ANY_IDENT = frozenset(("*", "*!*"))
+
+    def __init__(self, masks=()):
+        self._exact = {}
+        self._suffixes = {}
+        self._prefixes = {}
+        self._networks = {}
+        self._ident_regex = {}
+        self._fallback = []
+        self._regex = None
+        self.size = 0
+        for mask in masks:
+            self.add(mask)
+        self.compile()
+
+    def _ident(self, ident):
+        """Return the compiled regex for a nick!user glob, or None."""
+        if ident in self.ANY_IDENT:
+            return None
+
+        try:
+            return self._ident_regex[ident]
+        except KeyError:
+            regex = re.compile(glob_to_regex(ident) + "$")
+            self._ident_regex[ident] = regex
+            return regex
+
+    @staticmethod
+    def _network(hostname):
+        """Return the IP network hostname stands for, or None."""
+        if ipaddress is None:
+            return None
+
+        if '/' not in hostname:
+            labels = hostname.split('.')
+            if (not 1 < len(labels) <= 4 or labels[-1] != '*'
+                    or not all(x.isdigit() for x in labels[:-1])):
+                return None
+            hostname = "{address}/{bits}".format(
+                address=".".join(labels[:-1] + ['0'] * (5 - len(labels))),
+                bits=8 * (len(labels) - 1))
+
+        try:
+            return ipaddress.ip_network(hostname, strict=False)
+        except ValueError:
+            return None
+
+    def add(self, mask):
+        """Add a mask to the index."""
+        self.size += 1
+        if '@' not in mask:
+            self._fallback.append(glob_to_regex(mask))
+            return
+
+        (ident, hostname) = mask.split('@', 1)
+        hostname = hostname.lower()
+        ident_regex = self._ident(ident)
+
+        if '*' not in hostname and '?' not in hostname:
+            network = self._network(hostname)
+            if network is None:
+                self._exact.setdefault(hostname, []).append(ident_regex)
+                return
+            self._add_network(network, ident_regex)
+            return
+
+        network = self._network(hostname)
+        if network is not None:
+            self._add_network(network, ident_regex)
+            return
+
+        if '?' not in hostname:
+            if (hostname.startswith('*.') and '*' not in hostname[2:]):
+                node = self._suffixes
+                for label in reversed(hostname[2:].split('.')):
+                    node = node.setdefault(label, {})
+                node.setdefault(None, []).append(ident_regex)
+                return
+
+            if (hostname.endswith('/*') and '*' not in hostname[:-1]):
+                self._prefixes.setdefault(hostname[:-1], []).append(
+                    ident_regex)
+                return
+
+        self._fallback.append(host_to_regex(mask))
+
+    def _add_network(self, network, ident_regex):
+        """Add an IP network to the index."""
+        key = (network.version, network.prefixlen)
+        self._networks.setdefault(key, {}).setdefault(
+            int(network.network_address), []).append(ident_regex)
+
+    def compile(self):
+        """Compile the masks that couldn't be indexed into one regex."""
+        if self._fallback:
+            # Anchor the whole alternation, not just its last branch.
+            self._regex = re.compile("(?:{regexes})$".format(
+                regexes="|".join(
+                    "(?:{regex})".format(regex=regex)
+                    for regex in OrderedDict.fromkeys(self._fallback))))
+        else:
+            self._regex = None
+
+    @staticmethod
+    def _any_ident(ident_regexes, ident):
+        """Return True if ident matches any of the nick!user regexes."""
+        for regex in ident_regexes:
+            if regex is None or regex.match(ident):
+                return True
+        return False
+
+    def match(self, host):
+        """Return True if nick!user@host matches a mask in the index."""
+        (ident, _, hostname) = host.partition('@')
+        hostname = hostname.lower()
+
+        found = self._exact.get(hostname)
+        if found and self._any_ident(found, ident):
+            return True
+
+        if self._suffixes:
+            node = self._suffixes
+            labels = hostname.split('.')
+            for index in range(len(labels) - 1, 0, -1):
+                node = node.get(labels[index])
+                if node is None:
+                    break
+                found = node.get(None)
+                if found and self._any_ident(found, ident):
+                    return True
+
+        if self._prefixes:
+            index = hostname.find('/')
+            while index != -1:
+                found = self._prefixes.get(hostname[:index + 1])
+                if found and self._any_ident(found, ident):
+                    return True
+                index = hostname.find('/', index + 1)
+
+        if self._networks:
+            try:
+                address = ipaddress.ip_address(hostname)
+            except ValueError:
+                address = None
+            if address is not None:
+                value = int(address)
+                width = address.max_prefixlen
+                for ((version, bits), networks) in self._networks.items():
+                    if version != address.version:
+                        continue
+                    shift = width - bits
+                    found = networks.get(value >> shift << shift)
+                    if found and self._any_ident(found, ident):
+                        return True
+
+        if self._regex is not None:
+            return self._regex.match(
+                "{ident}@{hostname}".format(ident=ident, hostname=hostname)
+            ) is not None
+
+        return False
+
+
+class WhitelistMatcher(object):
+    """Precompiled form of the whitelists for use in the modifier hot path.
+
+    The whitelists are compiled once, when the config or database is read
+    or changed, so checking a message never has to touch either.
+    """
+    def __init__(self):
+        self.networks = frozenset()
+        self.nicks = frozenset()
+        self.channels = frozenset()
+        self._server_nicks = {}
+        self._server_channels = {}
+        self._hosts = HostIndex()
+        self._server_hosts = {}
+
+    def rebuild(self, whitelists):
+        """Rebuild the matcher from the current whitelist entries."""
+        self.networks = frozenset(whitelists.get('networks'))
+        self.nicks = frozenset(whitelists.get('nicks'))
+        self._server_nicks = {}
+
+        channels = set()
+        server_channels = {}
+        for channel in whitelists.get('channels'):
+            # Check for localised channel
+            if '@' in channel:
+                (channel, server) = channel.split('@', 1)
+                server_channels.setdefault(server, set()).add(
+                    channel_to_lower(channel))
+            else:
+                channels.add(channel_to_lower(channel))
+
+        self.channels = frozenset(channels)
+        self._server_channels = {
+            server: frozenset(names)
+            for server, names in server_channels.items()
+        }
+
+        hosts = []
+        server_hosts = {}
+        for host in whitelists.get('hosts'):
+            # Check for localised host
+            # @ will always exist in hosts, so try to split and just pass
+            # on ValueError, which means there was no @server portion.
+            try:
+                (white_name, white_host, server) = host.split('@', 2)
+                server_hosts.setdefault(server, []).append(
+                    "{name}@{host}".format(name=white_name, host=white_host))
+            except ValueError:
+                hosts.append(host)
+
+        self._hosts = HostIndex(hosts)
+        self._server_hosts = {
+            server: HostIndex(masks)
+            for server, masks in server_hosts.items()
+        }
+
+    def nicks_for(self, server):
+        """Return the set of nicks that are whitelisted on server.
+
+        Entries may be a bare nick, or a nick localised to the server name
+        or the server's current address with nick@server and nick@addr.
+        The result is cached until the whitelist or address changes.
+        """
+        try:
+            return self._server_nicks[server]
+        except KeyError:
+            pass
+
+        localities = (server, addresses.get(server))
+        nicks = set()
+        for entry in self.nicks:
+            if '@' in entry:
+                (nick, locality) = entry.split('@', 1)
+                if locality in localities:
+                    nicks.add(nick)
+            else:
+                nicks.add(entry)
+
+        nicks = frozenset(nicks)
+        self._server_nicks[server] = nicks
+        return nicks
+
+    def forget_server(self, server):
+        """Drop cached state for server, eg. after its address changed."""
+        self._server_nicks.pop(server, None)
+
+    def channels_for(self, server):
+        """Return the whitelisted channels that apply to server."""
+        try:
+            return self.channels | self._server_channels[server]
+        except KeyError:
+            return self.channels
+
+    def match_host(self, host, server):
+        """Return True if host matches a whitelisted mask for server."""
+        if self._hosts.match(host):
+            return True
+
+        try:
+            return self._server_hosts[server].match(host)
+        except KeyError:
+            return False
+
+
+class StageTimings(object):
+    """Call counts, total and maximum time and a latency histogram per stage.
+
+    Histogram buckets are bounded by TIMING_BUCKETS, with a final bucket
+    for anything slower.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._stages = {}
+
+    def record(self, stage, duration_ns):
+        """Record one call of stage that took duration_ns."""
+        try:
+            entry = self._stages[stage]
+        except KeyError:
+            entry = self._stages[stage] = [
+                0, 0, 0, [0] * (len(TIMING_BUCKETS) + 1)]
+
+        entry[0] += 1
+        entry[1] += duration_ns
+        entry[2] = max(entry[2], duration_ns)
+        entry[3][bisect.bisect_left(TIMING_BUCKETS,
+                                    duration_ns / 1000.0)] += 1
+
+    def timed(self, stage, func, *args):
+        """Call func(*args), recording its duration if timing is enabled."""
+        if not self.enabled:
+            return func(*args)
+
+        start = time.perf_counter_ns()
+        ret = func(*args)
+        self.record(stage, time.perf_counter_ns() - start)
         return ret
 
+    def reset(self):
+        """Forget all recorded timings."""
+        self._stages.clear()
+
+    def lines(self):
+        """Return the timings formatted for printing."""
+        lines = []
+        if not self._stages:
+            return lines
+
+        lines.append("{stage:<8} {calls:>8} {mean:>9} {max:>9}  {hist}".format(
+            stage="stage",
+            calls="calls",
+            mean="mean us",
+            max="max us",
+            hist=" ".join("<{b}".format(b=b) for b in TIMING_BUCKETS)
+            + " >{b} us".format(b=TIMING_BUCKETS[-1])))
+
+        for stage in TIMING_STAGES:
+            try:
+                (calls, total, slowest, histogram) = self._stages[stage]
+            except KeyError:
+                continue
+
+            lines.append("{stage:<8} {calls:>8} {mean:>9.2f} {max:>9.2f}  "
+                         "{hist}".format(
+                             stage=stage,
+                             calls=calls,
+                             mean=total / calls / 1000.0,
+                             max=slowest / 1000.0,
+                             hist=" ".join(str(n) for n in histogram)))
+        return lines
+
+
+class FloodGuard(object):
+    """Token buckets limiting the blocked messages processed per host.
+
+    Every blocked message takes a token from its host's bucket, which
+    refills at rate tokens per minute up to burst. Once a bucket is empty,
+    further blocked messages from that host are dropped without being
+    notified, logged or held. Whitelisted senders are let through before
+    the buckets are looked at, so they are never dropped.
+    """
+    def __init__(self, burst=0, rate=0):
+        self.burst = burst
+        self.rate = rate
+        self.dropped = 0
+        self._buckets = {}
+
+    def configure(self, burst, rate):
+        """Set the bucket size and refill rate, resetting all buckets."""
+        self.burst = burst
+        self.rate = rate
+        self._buckets.clear()
+
+    def _refill(self, bucket, now):
+        """Top up a [tokens, timestamp] bucket for the time elapsed."""
+        bucket[0] = min(
+            self.burst,
+            bucket[0] + (now - bucket[1]) * self.rate / 60.0)
+        bucket[1] = now
+
+    def is_flooding(self, key):
+        """Return True if blocked messages for key should be dropped."""
+        if self.burst <= 0:
+            return False
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return False
+
+        self._refill(bucket, time.time())
+        if bucket[0] < 1:
+            self.dropped += 1
+            return True
+
+        return False
+
+    def consume(self, key):
+        """Take a token from the bucket for key."""
+        if self.burst <= 0:
+            return
+
+        now = time.time()
+        bucket = self._buckets.get(key)
+
+        if bucket is None:
+            if len(self._buckets) >= FLOOD_MAX_BUCKETS:
+                self.prune()
+            bucket = self._buckets[key] = [self.burst, now]
+        else:
+            self._refill(bucket, now)
+
+        bucket[0] -= 1
+
+    def clear(self):
+        """Refill every bucket, eg. after the whitelists changed."""
+        self._buckets.clear()
+
+    def prune(self):
+        """Drop buckets that have refilled, or all of them if none have."""
+        now = time.time()
+        for key, bucket in list(self._buckets.items()):
+            self._refill(bucket, now)
+            if bucket[0] >= self.burst:
+                del self._buckets[key]
+
+        if len(self._buckets) >= FLOOD_MAX_BUCKETS:
+            self._buckets.clear()
+
+
+class BlockedNotifier(object):
+    """Prints blocked message notifications, optionally coalesced.
+
+    With an interval set, blocked messages are counted and a single
+    summary line is printed from a timer. Flood dropped messages are
+    always summarised rather than printed individually.
+    """
+    def __init__(self, interval=0):
+        self.interval = interval
+        self._messages = 0
+        self._hosts = set()
+        self._timer = None
+
+    def notify(self, server, nick, host, flooded=False):
+        """Notify about a blocked message."""
+        if self.interval <= 0 and not flooded:
+            weechat.prnt(
+                "",
+                "[{server}] {nick} [{host}] "
+                "attempted to send you a private message.".format(
+                    server=server,
+                    nick=nick,
+                    host=host))
+            return
+
+        self._messages += 1
+        self._hosts.add((server, host.split('@', 1)[-1]))
+
+        if self._timer is None:
+            self._timer = weechat.hook_timer(
+                (self.interval or FLOOD_SUMMARY_INTERVAL) * 1000,
+                0, 1, "whitelist_notify_cb", "")
+
+    def summarise(self):
+        """Print a summary of the messages blocked since the last one."""
+        self._timer = None
+
+        if not self._messages:
+            return
+
+        weechat.prnt(
+            "",
+            "{name}: blocked {messages} messages from {hosts} hosts "
+            "in the last {interval}s".format(
+                name=SCRIPT_NAME,
+                messages=self._messages,
+                hosts=len(self._hosts),
+                interval=self.interval or FLOOD_SUMMARY_INTERVAL))
+
+        self._messages = 0
+        self._hosts = set()
+
+
+class BlockedLog(object):
+    """Buffered writer for the blocked message log.
+
+    Lines are kept in memory and written out in one go from a timer, when
+    the buffer reaches max_lines, or when the script is unloaded. The file
+    is kept open between writes and optionally rotated by size.
+    """
+    def __init__(self, path, flush_interval=1000, max_lines=1000,
+                 rotate_size=0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_lines = max_lines
+        self.rotate_size = rotate_size
+        self.dropped = 0
+        self._lines = []
+        self._file = None
+        self._timer = None
+
+    def configure(self, flush_interval, max_lines, rotate_size):
+        """Update the flush interval, buffer cap and rotation size."""
+        self.flush_interval = flush_interval
+        self.max_lines = max_lines
+        self.rotate_size = rotate_size
+
+    def write(self, line):
+        """Buffer a line, flushing if the buffer is full."""
+        self._lines.append(line)
+
+        if len(self._lines) >= self.max_lines or self.flush_interval <= 0:
+            self.flush()
+        elif self._timer is None:
+            self._timer = weechat.hook_timer(
+                self.flush_interval, 0, 1, "whitelist_log_flush_cb", "")
+
+    def flush(self):
+        """Write any buffered lines to the log file."""
+        if self._timer is not None:
+            weechat.unhook(self._timer)
+            self._timer = None
+
+        if not self._lines:
+            return
+
+        lines = self._lines
+        self._lines = []
+
+        try:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+
+            self._file.write("".join(lines))
+            self._file.flush()
+
+            if self.rotate_size and self._file.tell() >= self.rotate_size:
+                self.rotate()
+        except (IOError, OSError) as err:
+            self.dropped += len(lines)
+            self.close()
+            weechat.prnt("", "{name}: unable to write {path}: {err}".format(
+                name=SCRIPT_NAME,
+                path=self.path,
+                err=err))
+
+    def rotate(self):
+        """Move the current log file aside and start a new one."""
+        self.close()
+        os.rename(self.path, "{path}.1".format(path=self.path))
+
+    def close(self):
+        """Close the log file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def timer_fired(self):
+        """Note that the one-shot flush timer has fired."""
+        self._timer = None
+
+
+class HeldMessages(object):
+    """Fixed size buffer of blocked messages, held for /whitelist accept.
+
+    Messages are (sequence, time, host, text) tuples kept per sender, a
+    (server, lowercased nick) pair, with a deque of (sequence, sender) in
+    arrival order. When the buffer is full the oldest message is dropped,
+    and when a sender reaches per_sender their oldest message is dropped.
+    Entries in the arrival order whose message was already dropped are
+    skipped, and the order is rebuilt if they pile up, so memory use is
+    bounded by size.
+    """
+    def __init__(self, size=0, per_sender=1):
+        self.size = size
+        self.per_sender = per_sender
+        self.evicted = 0
+        self.capped = 0
+        self._senders = {}
+        self._order = deque()
+        self._count = 0
+        self._sequence = 0
+
+    def __len__(self):
+        return self._count
+
+    def senders(self):
+        """Return the number of senders with held messages."""
+        return len(self._senders)
+
+    def configure(self, size, per_sender):
+        """Set the size and per sender cap, dropping messages over them."""
+        self.size = size
+        self.per_sender = per_sender
+
+        for (sender, messages) in list(self._senders.items()):
+            while len(messages) > per_sender:
+                messages.popleft()
+                self._count -= 1
+                self.capped += 1
+            if not messages:
+                del self._senders[sender]
+
+        self._evict(size)
+        self._compact()
+
+    def add(self, server, nick, host, text):
+        """Hold a message, dropping the oldest ones to make room."""
+        if self.size <= 0:
+            return
+
+        sender = (server, nick.lower())
+        messages = self._senders.get(sender)
+        if messages is not None and len(messages) >= self.per_sender:
+            messages.popleft()
+            self._count -= 1
+            self.capped += 1
+            if not messages:
+                del self._senders[sender]
+
+        # Evicting can drop the sender's last message and their deque, so
+        # only look it up afterwards.
+        self._evict(self.size - 1)
+        messages = self._senders.setdefault(sender, deque())
+
+        self._sequence += 1
+        messages.append((self._sequence, int(time.time()), host, text))
+        self._order.append((self._sequence, sender))
+        self._count += 1
+
+        if len(self._order) > 2 * self.size:
+            self._compact()
+
+    def _evict(self, limit):
+        """Drop the oldest messages until at most limit are held."""
+        while self._count > limit and self._order:
+            (sequence, sender) = self._order.popleft()
+            messages = self._senders.get(sender)
+            if not messages or messages[0][0] != sequence:
+                # Already dropped by the per sender cap or taken.
+                continue
+
+            messages.popleft()
+            if not messages:
+                del self._senders[sender]
+            self._count -= 1
+            self.evicted += 1
+
+    def _compact(self):
+        """Rebuild the arrival order from the messages still held."""
+        self._order = deque(sorted(
+            (message[0], sender)
+            for (sender, messages) in self._senders.items()
+            for message in messages))
+
+    def take(self, nick):
+        """Remove and return the messages held from nick.
+
+        Returns a dict of server to a list of (time, host, text) tuples.
+        """
+        nick = nick.lower()
+        taken = {}
+        for sender in [x for x in self._senders if x[1] == nick]:
+            messages = self._senders.pop(sender)
+            self._count -= len(messages)
+            taken[sender[0]] = [message[1:] for message in messages]
+
+        if taken:
+            self._compact()
+        return taken
+
+    def reset_stats(self):
+        """Reset the eviction counters."""
+        self.evicted = 0
+        self.capped = 0
+
+
+class Quarantine(object):
+    """Searchable store of blocked messages, kept in a SQLite database.
+
+    Messages are buffered like BlockedLog lines and inserted in one
+    transaction. Nicks, hosts and reversed hosts are indexed, so searches
+    for a nick, an exact host, a host prefix like user/* or a domain like
+    *.isp.com don't scan the table. Text is indexed with FTS5 when SQLite
+    has it. Old messages are deleted by a child process run with
+    hook_process, see whitelist_quarantine_compact(). That needs WeeChat
+    1.5, older versions keep every message.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.enabled = False
+        self.flush_interval = 1000
+        self.max_rows = 1000
+        self.days = 0
+        self.max_messages = 0
+        self.fts = False
+        self.dropped = 0
+        self._rows = []
+        self._db = None
+        self._timer = None
+        self._compact_timer = None
+        self._compact_hook = None
+
+    def configure(self, enabled, flush_interval, max_rows, days,
+                  max_messages):
+        """Update the options, starting or stopping the compaction timer."""
+        if self.enabled and not enabled:
+            self.flush()
+        self.enabled = enabled and sqlite3 is not None
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.days = days
+        self.max_messages = max_messages
+
+        if self._compact_timer is not None:
+            weechat.unhook(self._compact_timer)
+            self._compact_timer = None
+
+        if self.enabled and (days or max_messages):
+            self._compact_timer = weechat.hook_timer(
+                QUARANTINE_COMPACT_INTERVAL * 1000, 0, 0,
+                "whitelist_quarantine_timer_cb", "")
+
+    @staticmethod
+    def connect(path, timeout=1):
+        """Open the database at path, creating the tables if needed.
+
+        Returns (connection, fts), fts is True if text is indexed.
+        """
+        db = sqlite3.connect(path, timeout=timeout)
+        try:
+            # auto_vacuum has to be set before anything creates the file.
+            db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            # WAL lets the compaction process run alongside inserts, and
+            # with synchronous NORMAL commits don't wait for an fsync.
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            with db:
+                db.execute("CREATE TABLE IF NOT EXISTS blocked ("
+                           "id INTEGER PRIMARY KEY, time INTEGER NOT NULL, "
+                           "server TEXT, nick TEXT, host TEXT, "
+                           "hostname TEXT, rhostname TEXT, text TEXT)")
+                for column in ("time", "nick COLLATE NOCASE", "hostname",
+                               "rhostname"):
+                    db.execute("CREATE INDEX IF NOT EXISTS blocked_{name} "
+                               "ON blocked ({column})".format(
+                                   name=column.split()[0], column=column))
+
+                try:
+                    db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS "
+                               "blocked_text USING fts5(text, "
+                               "content='blocked', content_rowid='id')")
+                except sqlite3.OperationalError:
+                    fts = False
+                else:
+                    fts = True
+                    db.execute("CREATE TRIGGER IF NOT EXISTS blocked_insert "
+                               "AFTER INSERT ON blocked BEGIN "
+                               "INSERT INTO blocked_text (rowid, text) "
+                               "VALUES (new.id, new.text); END")
+                    db.execute("CREATE TRIGGER IF NOT EXISTS blocked_delete "
+                               "AFTER DELETE ON blocked BEGIN "
+                               "INSERT INTO blocked_text "
+                               "(blocked_text, rowid, text) "
+                               "VALUES ('delete', old.id, old.text); END")
+        except sqlite3.Error:
+            db.close()
+            raise
+
+        return (db, fts)
+
+    def _connection(self):
+        """Return the open database, opening it on first use."""
+        if self._db is None:
+            (self._db, self.fts) = self.connect(self.path)
+        return self._db
+
+    def add(self, server, nick, host, text):
+        """Buffer a blocked message, flushing if the buffer is full."""
+        hostname = host.split('@', 1)[-1].lower()
+        self._rows.append((int(time.time()), server, nick, host, hostname,
+                           hostname[::-1], text))
+
+        if len(self._rows) >= self.max_rows or self.flush_interval <= 0:
+            self.flush()
+        elif self._timer is None:
+            self._timer = weechat.hook_timer(
+                self.flush_interval, 0, 1, "whitelist_quarantine_flush_cb",
+                "")
+
+    def flush(self):
+        """Insert any buffered messages."""
+        if self._timer is not None:
+            weechat.unhook(self._timer)
+            self._timer = None
+
+        if not self._rows:
+            return
+
+        rows = self._rows
+        self._rows = []
+
+        try:
+            db = self._connection()
+            with db:
+                db.executemany(
+                    "INSERT INTO blocked (time, server, nick, host, "
+                    "hostname, rhostname, text) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    rows)
+        except sqlite3.Error as err:
+            self.dropped += len(rows)
+            weechat.prnt("", "{name}: unable to write {path}: {err}".format(
+                name=SCRIPT_NAME,
+                path=self.path,
+                err=err))
+
+    def search(self, field=None, term=None, limit=QUARANTINE_DEFAULT_LIMIT):
+        """Return the newest limit messages matching term, oldest first.
+
+        Messages are (time, server, nick, host, text) tuples. field is
+        'nick', 'host' or 'text', or None for any message. Hosts may use *
+        as a wildcard, a nick!user@host mask matches the whole host.
+
+        Raises sqlite3.Error if the database can't be read.
+        """
+        self.flush()
+        db = self._connection()
+
+        select = ("SELECT b.time, b.server, b.nick, b.host, b.text "
+                  "FROM blocked AS b")
+        if field is None:
+            (where, args) = ("", ())
+        elif field == 'nick':
+            (where, args) = ("WHERE nick = ? COLLATE NOCASE", (term,))
+        elif field == 'host':
+            (where, args) = self._host_where(term)
+        elif self.fts:
+            where = ("JOIN blocked_text ON blocked_text.rowid = b.id "
+                     "WHERE blocked_text MATCH ?")
+            args = ('"{term}"'.format(term=term.replace('"', '""')),)
+        else:
+            (where, args) = ("WHERE text LIKE ?", (
+                "%{term}%".format(term=term),))
+
+        rows = db.execute(
+            "{select} {where} ORDER BY b.id DESC LIMIT ?".format(
+                select=select, where=where),
+            args + (limit,)).fetchall()
+        rows.reverse()
+        return rows
+
+    @staticmethod
+    def _host_where(mask):
+        """Return the WHERE clause and arguments for a host search."""
+        if '@' in mask:
+            return ("WHERE host GLOB ?", (mask,))
+
+        mask = mask.lower()
+        if '*' not in mask and '?' not in mask:
+            return ("WHERE hostname = ?", (mask,))
+
+        # A leading * is a trailing * on the reversed host, which can use
+        # the index.
+        if (mask.startswith('*') and '*' not in mask[1:]
+                and '?' not in mask):
+            return ("WHERE rhostname GLOB ?", (mask[::-1],))
+
+        return ("WHERE hostname GLOB ?", (mask,))
+
+    def compact(self):
+        """Start deleting old messages in a child process."""
+        if (self._compact_hook is not None or not self.enabled
+                or not (self.days or self.max_messages)):
+            return
+
+        # Deleting in WeeChat itself would block it for the whole vacuum.
+        version = weechat.info_get("version_number", "") or 0
+        if int(version) < WEECHAT_VERSION_HEX_1_5_0:
+            return
+
+        self.flush()
+        self._compact_hook = weechat.hook_process(
+            "func:whitelist_quarantine_compact",
+            QUARANTINE_COMPACT_TIMEOUT,
+            "whitelist_quarantine_compact_cb",
+            "{days} {max_messages} {path}".format(
+                days=self.days,
+                max_messages=self.max_messages,
+                path=self.path))
+
+    def compacted(self):
+        """Note that the compaction process has finished."""
+        self._compact_hook = None
+
+    def close(self):
+        """Write buffered messages, stop the timers and close the database."""
+        self.flush()
+
+        for hook in (self._compact_timer, self._compact_hook):
+            if hook is not None:
+                weechat.unhook(hook)
+        self._compact_timer = None
+        self._compact_hook = None
+
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class VerdictCache(object):
+    """LRU cache of whitelist verdicts keyed by (server, nick).
+
+    Each entry remembers the host it was computed for and when it expires,
+    a different host or an expired entry counts as a miss.
+    """
+    def __init__(self, size=0, ttl=0):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def configure(self, size, ttl):
+        """Set the maximum size and TTL, dropping existing entries."""
+        self.size = size
+        self.ttl = ttl
+        self.clear()
+
+    def get(self, server, nick, host):
+        """Return the cached verdict, or None on a miss."""
+        key = (server, nick)
+        entry = self._entries.pop(key, None)
+
+        if entry is not None:
+            (cached_host, verdict, expires) = entry
+            if cached_host == host and expires > time.time():
+                # Re-insert to mark it as most recently used.
+                self._entries[key] = entry
+                self.hits += 1
+                return verdict
+
+        self.misses += 1
+        return None
+
+    def put(self, server, nick, host, verdict):
+        """Cache a verdict, evicting the least recently used entry."""
+        if self.size <= 0 or self.ttl <= 0:
+            return
+
+        key = (server, nick)
+        self._entries.pop(key, None)
+        self._entries[key] = (host, verdict, time.time() + self.ttl)
+
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, server, nick):
+        """Drop the cached verdict for nick on server."""
+        self._entries.pop((server, nick), None)
+
+    def invalidate_server(self, server):
+        """Drop all cached verdicts for server."""
+        for key in [k for k in self._entries if k[0] == server]:
+            del self._entries[key]
+
+    def clear(self):
+        """Drop all cached verdicts."""
+        self._entries.clear()
+
+    def reset_stats(self):
+        """Reset the hit and miss counters."""
+        self.hits = 0
+        self.misses = 0
+
+
+class ServerAddresses(object):
+    """Cache of the current_address of each IRC server.
+
+    Entries are dropped on irc_server_connected and irc_server_disconnected
+    and fetched again from the irc_server infolist on next use.
+    """
+    def __init__(self):
+        self._addresses = {}
+
+    def get(self, server):
+        """Return the current address of server."""
+        try:
+            return self._addresses[server]
+        except KeyError:
+            pass
+
+        with InfolistGenerator("irc_server", "", server,
+                               columns=('current_address',)) as infolist:
+            address = infolist.get_field('current_address')
+
+        self._addresses[server] = address
+        return address
+
+    def invalidate(self, server):
+        """Forget the cached address of server."""
+        self._addresses.pop(server, None)
+
+
+class MembershipIndex(object):
+    """Per-server index of the channels that each nick is in.
+
+    Servers are seeded from the irc_channel and irc_nick infolists the first
+    time they're looked up, after that the index is kept up to date from
+    JOIN, PART, KICK, QUIT, NICK and RPL_NAMREPLY signals. Channel names are
+    folded with channel_to_lower().
+    """
+    def __init__(self):
+        self._servers = {}
+
+    def _nicks(self, server):
+        """Return the nick to channels mapping for server, seeding it."""
+        try:
+            return self._servers[server]
+        except KeyError:
+            pass
+
+        nicks = {}
+        for channel in whitelist_get_channels(server):
+            folded = channel_to_lower(channel)
+            for nick in whitelist_get_channel_nicks(server, channel):
+                nicks.setdefault(nick, set()).add(folded)
+
+        self._servers[server] = nicks
+        return nicks
+
+    def reset_server(self, server):
+        """Start tracking server from an empty state."""
+        self._servers[server] = {}
+
+    def drop_server(self, server):
+        """Forget everything known about server."""
+        self._servers.pop(server, None)
+
+    def channels(self, server, nick):
+        """Return the set of channels that nick is in on server."""
+        return self._nicks(server).get(nick, frozenset())
+
+    def is_in(self, server, nick, channel):
+        """Return True if nick is in channel on server."""
+        return channel_to_lower(channel) in self.channels(server, nick)
+
+    def add(self, server, nick, channel):
+        """Record that nick is in channel."""
+        self._nicks(server).setdefault(nick, set()).add(
+            channel_to_lower(channel))
+
+    def remove(self, server, nick, channel):
+        """Record that nick has left channel."""
+        nicks = self._nicks(server)
+        channels = nicks.get(nick)
+
+        if channels is None:
+            return
+
+        channels.discard(channel_to_lower(channel))
+        if not channels:
+            del nicks[nick]
+
+    def remove_channel(self, server, channel):
+        """Forget all nicks in channel, used when we leave it."""
+        nicks = self._nicks(server)
+        channel = channel_to_lower(channel)
+
+        for nick in [n for n, c in nicks.items() if channel in c]:
+            self.remove(server, nick, channel)
+
+    def quit(self, server, nick):
+        """Record that nick has left the server."""
+        self._nicks(server).pop(nick, None)
+
+    def rename(self, server, old_nick, new_nick):
+        """Record a nick change."""
+        nicks = self._nicks(server)
+        channels = nicks.pop(old_nick, None)
+
+        if channels is not None:
+            nicks.setdefault(new_nick, set()).update(channels)
+
+
+def whitelist_rebuild():
+    """Recompile the whitelists and forget what was decided before."""
+    matcher.rebuild(entries)
+    verdicts.clear()
+    flood.clear()
+
 
 def whitelist_config_reload_cb(userdata, config_file):
     """Callback after the config file has been reloaded."""
-    return weechat.WEECHAT_CONFIG_READ_OK
+    ret = weechat.config_reload(config_file)
+    config.refresh_all()
+    whitelist_open_store()
+    return ret
+
+
+def whitelist_database_option_change_cb(userdata, option):
+    """Callback when a database option was changed."""
+    whitelist_open_store()
+    return weechat.WEECHAT_RC_OK
+
+
+def whitelist_store_poll_cb(userdata, remaining_calls):
+    """Timer callback to reload the whitelists if the database changed."""
+    try:
+        if store.changed():
+            entries.replace(store.load())
+            whitelist_rebuild()
+    except sqlite3.Error as err:
+        weechat.prnt("", "Whitelist error. Can't read {path}: {err}".format(
+            path=store.path, err=err))
+    return weechat.WEECHAT_RC_OK
+
+
+def whitelist_open_store():
+    """Load the whitelists from the database, or the config if it's unset.
+
+    A new, empty database is filled with the entries from the config.
+    """
+    store.close()
+    entries.load(config)
+
+    path = config.get_value('general', 'database')
+    if path:
+        path = whitelist_path(path)
+        try:
+            if sqlite3 is None:
+                raise ImportError("the sqlite3 module is not available")
+            store.open(
+                path, config.get_value('general', 'database_poll_interval'))
+            if store.is_empty():
+                for listtype in SCRIPT_CONFIG['whitelists']:
+                    store.update(listtype, added=entries.get(listtype))
+            entries.replace(store.load())
+        except (ImportError, sqlite3.Error) as err:
+            store.close()
+            weechat.prnt("", "Whitelist error. Can't use database {path}, "
+                             "using the whitelists options: {err}".format(
+                                 path=path, err=err))
+
+    whitelist_rebuild()
+
+
+def whitelist_log_option_change_cb(userdata, option):
+    """Callback when a log option was changed."""
+    blocked_log.configure(
+        config.get_value('general', 'log_flush_interval'),
+        config.get_value('general', 'log_max_lines'),
+        config.get_value('general', 'log_rotate_size') * 1024)
+    whitelist_quarantine_configure()
+    return weechat.WEECHAT_RC_OK
+
+
+def whitelist_log_flush_cb(userdata, remaining_calls):
+    """Timer callback to write out the buffered log lines."""
+    blocked_log.timer_fired()
+    blocked_log.flush()
+    return weechat.WEECHAT_RC_OK
+
+
+def whitelist_hold_option_change_cb(userdata, option):
+    """Callback when a held message option was changed."""
+    held.configure(
+        config.get_value('general', 'hold_size'),
+        config.get_value('general', 'hold_per_sender'))
+    return weechat.WEECHAT_RC_OK
+
+
+def whitelist_quarantine_option_change_cb(userdata, option):
+    """Callback when a quarantine option was changed."""
+    whitelist_quarantine_configure()
+    return weechat.WEECHAT_RC_OK
+
+
+def whitelist_quarantine_configure():
+    """Apply the quarantine and log buffering options to the quarantine."""
+    quarantine.configure(
+        config.get_value('general', 'quarantine'),
+        config.get_value('general', 'log_flush_interval'),
+        config.get_value('general', 'log_max_lines'),
+        config.get_value('general', 'quarantine_days'),
+        config.get_value('general', 'quarantine_max_messages'))
+
+
+def whitelist_quarantine_flush_cb(userdata, remaining_calls):
+    """Timer callback to insert the buffered blocked messages."""
+    quarantine.flush()
+    return weechat.WEECHAT_RC_OK
+
+
+def whitelist_quarantine_timer_cb(userdata, remaining_calls):
+    """Timer callback to start compacting the blocked message database."""
+    quarantine.compact()
+    return weechat.WEECHAT_RC_OK
+
+
+def whitelist_quarantine_compact(userdata):
+    """Delete old blocked messages, in the child started by hook_process.
+
+    userdata is "<days> <max messages> <database path>". Returns the number
+    of messages deleted.
+    """
+    (days, max_messages, path) = userdata.split(" ", 2)
+    (days, max_messages) = (int(days), int(max_messages))
+
+    (db, fts) = Quarantine.connect(path, timeout=60)
+    deleted = 0
+    try:
+        with db:
+            if days:
+                deleted += db.execute(
+                    "DELETE FROM blocked WHERE time < ?",
+                    (int(time.time()) - days * 86400,)).rowcount
+            if max_messages:
+                deleted += db.execute(
+                    "DELETE FROM blocked WHERE id <= (SELECT id FROM blocked "
+                    "ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                    (max_messages,)).rowcount
+            if deleted and fts:
+                db.execute("INSERT INTO blocked_text (blocked_text) "
+                           "VALUES ('optimize')")
+        if deleted:
+            db.execute("PRAGMA incremental_vacuum")
+    finally:
+        db.close()
+
+    return str(deleted)
+
+
+def whitelist_quarantine_compact_cb(userdata, command, return_code, out, err):
+    """Callback when the compaction process has finished."""
+    if return_code == weechat.WEECHAT_HOOK_PROCESS_RUNNING:
+        return weechat.WEECHAT_RC_OK
+
+    quarantine.compacted()
+    if return_code == weechat.WEECHAT_HOOK_PROCESS_ERROR or err:
+        weechat.prnt("", "{name}: unable to compact {path}: {err}".format(
+            name=SCRIPT_NAME,
+            path=quarantine.path,
+            err=err.strip() or return_code))
+    return weechat.WEECHAT_RC_OK
+
+
+def whitelist_flood_option_change_cb(userdata, option):
+    """Callback when a flood or notification option was changed."""
+    flood.configure(
+        config.get_value('general', 'flood_burst'),
+        config.get_value('general', 'flood_rate'))
+    notifier.interval = config.get_value('general', 'notification_interval')
+    return weechat.WEECHAT_RC_OK
+
+
+def whitelist_timing_option_change_cb(userdata, option):
+    """Callback when the timing option was changed."""
+    timings.enabled = bool(config.get_value('general', 'timing'))
+    return weechat.WEECHAT_RC_OK
+
+
+def whitelist_notify_cb(userdata, remaining_calls):
+    """Timer callback to print the coalesced notification summary."""
+    notifier.summarise()
+    return weechat.WEECHAT_RC_OK
+
+
+def whitelist_unload_cb():
+    """Flush and close the log when the script is unloaded."""
+    blocked_log.flush()
+    blocked_log.close()
+    quarantine.close()
+    store.close()
+    return weechat.WEECHAT_RC_OK
+
+
+def whitelist_cache_option_change_cb(userdata, option):
+    """Callback when a verdict cache option was changed."""
+    verdicts.configure(
+        config.get_value('general', 'cache_size'),
+        config.get_value('general', 'cache_ttl'))
+    return weechat.WEECHAT_RC_OK
+
+
+def whitelist_verdict_option_change_cb(userdata, option):
+    """Callback when an option that changes verdicts was changed."""
+    verdicts.clear()
+    return weechat.WEECHAT_RC_OK
+
+
+def whitelist_config_value_change_cb(userdata, option):
+    """Callback for every option change, keeps the Config cache fresh.
+
+    Calls on to the change_cb configured for the option in SCRIPT_CONFIG.
+    """
+    (section_name, option_name) = userdata.split(".", 1)
+    config.refresh(section_name, option_name)
+
+    props = SCRIPT_CONFIG[section_name][option_name]
+    if props['change_cb']:
+        return globals()[props['change_cb']](props['change_data'], option)
+
+    return weechat.WEECHAT_RC_OK
 
 
 def whitelist_config_option_change_cb(userdata, option):
     """Callback when a config option was changed."""
-    values = ", ".join(config.get_value('whitelists', userdata).split())
+    # The options aren't used while the whitelists are in the database.
+    if entries.batching or store.enabled:
+        return weechat.WEECHAT_RC_OK
+
+    entries.load(config, userdata)
+    whitelist_rebuild()
+    whitelist_print_type(userdata)
+    return weechat.WEECHAT_RC_OK
+
+
+def whitelist_print_type(listtype):
+    """Print the entries of a whitelist."""
     text = "Whitelisted {type} now: {values}".format(
-            type=userdata,
-            values=values)
+            type=listtype,
+            values=", ".join(sorted(entries.get(listtype))))
 
     weechat.prnt("", text)
+
+
+def whitelist_membership_signal_cb(userdata, signal, signal_data):
+    """Update the membership index from IRC membership changes."""
+    server = signal.split(",", 1)[0]
+    (source, command, params) = split_irc_message(signal_data)
+    nick = source.split("!", 1)[0]
+
+    if command == 'JOIN' and params:
+        channel = params[0]
+        if nick == weechat.info_get("irc_nick", server):
+            # We've joined, names will follow in RPL_NAMREPLY.
+            membership.remove_channel(server, channel)
+            verdicts.invalidate_server(server)
+        membership.add(server, nick, channel)
+        verdicts.invalidate(server, nick)
+
+    elif command == 'PART' and params:
+        for channel in params[0].split(","):
+            if nick == weechat.info_get("irc_nick", server):
+                membership.remove_channel(server, channel)
+                verdicts.invalidate_server(server)
+            else:
+                membership.remove(server, nick, channel)
+                verdicts.invalidate(server, nick)
+
+    elif command == 'KICK' and len(params) > 1:
+        (channel, victim) = params[:2]
+        if victim == weechat.info_get("irc_nick", server):
+            membership.remove_channel(server, channel)
+            verdicts.invalidate_server(server)
+        else:
+            membership.remove(server, victim, channel)
+            verdicts.invalidate(server, victim)
+
+    elif command == 'QUIT':
+        membership.quit(server, nick)
+        verdicts.invalidate(server, nick)
+
+    elif command == 'NICK' and params:
+        membership.rename(server, nick, params[0])
+        verdicts.invalidate(server, nick)
+        verdicts.invalidate(server, params[0])
+
+    elif command == '353' and len(params) > 3:
+        channel = params[2]
+        # /names for a channel we're not in must not count as sharing it.
+        if not membership.is_in(server, weechat.info_get("irc_nick", server),
+                                channel):
+            return weechat.WEECHAT_RC_OK
+
+        for name in params[3].split():
+            name = name.lstrip(NICK_PREFIXES).split("!", 1)[0]
+            if name:
+                membership.add(server, name, channel)
+                verdicts.invalidate(server, name)
+
+    return weechat.WEECHAT_RC_OK
+
+
+def whitelist_server_signal_cb(userdata, signal, signal_data):
+    """Reset per-server state when a server connects or disconnects."""
+    addresses.invalidate(signal_data)
+    matcher.forget_server(signal_data)
+    verdicts.invalidate_server(signal_data)
+
+    if signal == "irc_server_connected":
+        membership.reset_server(signal_data)
+    else:
+        membership.drop_server(signal_data)
+
     return weechat.WEECHAT_RC_OK
 
 
 def whitelist_get_channels(server):
     """Get a list of channels on the given server."""
     with InfolistGenerator("irc_channel", "", server) as infolist:
-        for row in infolist:
-            if row['name'].startswith(CHANNEL_PREFIX):
-                yield row['name']
+        names = infolist.column('name')
+
+    for name in names:
+        if name.startswith(CHANNEL_PREFIX):
+            yield name
 
 
 def whitelist_get_channel_nicks(server, channel):
@@ -457,8 +2438,10 @@ def whitelist_get_channel_nicks(server, channel):
     arg = "{server},{channel}".format(server=server, channel=channel)
 
     with InfolistGenerator("irc_nick", "", arg) as infolist:
-        for row in infolist:
-            yield row['name']
+        names = infolist.column('name')
+
+    for name in names:
+        yield name
 
 
 def whitelist_completion_sections(userdata, completion_item, buf, completion):
@@ -475,27 +2458,16 @@ def whitelist_completion_sections(userdata, completion_item, buf, completion):
 
 def whitelist_log(line):
     """Append a line to the whitelist log file."""
-    log_file = "{weechat_dir}/whitelist.log".format(weechat_dir=WEECHAT_DIR)
-
-    with open(log_file, 'a') as logfile:
-        logfile.write(line)
+    blocked_log.write(line)
 
 
 def whitelist_check_server(nick, server):
     """Check if server is whitelisted"""
-    networks = [x for x
-                in config.get_value('whitelists', 'networks').split(" ")
-                if x]
-
-    if server in networks:
+    if server in matcher.networks:
         # If we're only accepting messages from people in our channels...
         if config.get_value('general', 'network_channel_only'):
-            # Get a list of channels
-            for channel in whitelist_get_channels(server):
-                # And check if they're in it.
-                if nick in whitelist_get_channel_nicks(server, channel):
-                    # Accept it if they are.
-                    return True
+            # Accept it if they're in any channel with us.
+            return bool(membership.channels(server, nick))
         else:
             # Otherwise just accept the message.
             return True
@@ -505,84 +2477,37 @@ def whitelist_check_server(nick, server):
 
 def whitelist_check_nick(nick, server):
     """Check if nick is whitelisted"""
-    with InfolistGenerator("irc_server", server, "") as infolist:
-        current_address = infolist.get_field('current_address')
-
-    nicks = [x for x
-             in config.get_value('whitelists', 'nicks').split(" ")
-             if x]
-
-    for whitelisted_nick in nicks:
-        variations = [
-            # Simple check, is the nick itself whitelisted.
-            nick,
-            # Nick localised to the current server
-            "{nick}@{server}".format(nick=nick, server=server),
-            # Nick localised to the current server addr
-            "{nick}@{addr}".format(nick=nick, addr=current_address),
-            ]
-
-        if whitelisted_nick in variations:
-            return True
-
-    return False
+    return nick in matcher.nicks_for(server)
 
 
 def whitelist_check_host(host, server):
     """Check if host is whitelisted"""
-    hosts = [x for x
-             in config.get_value('whitelists', 'hosts').split(" ")
-             if x]
-
-    for whitelisted_host in hosts:
-        # Check for localised host
-        # @ will always exist in hosts, so try to split and just pass
-        # on ValueError, which means there was no @server portion.
-        try:
-            (white_name, white_host, whitelisted_server) = (
-                whitelisted_host.split('@', 2)
-            )
-
-            # Skip if this host is for another server
-            if server != whitelisted_server:
-                continue
-
-            # Fixup the whitelisted_host
-            whitelisted_host = "{name}@{host}".format(
-                name=white_name,
-                host=white_host)
-        except ValueError:
-            pass
-
-        # Check if the whitelisted host matches.
-        if re.match(host_to_regex(whitelisted_host), host):
-            return True
-
-    return False
+    return matcher.match_host(host, server)
 
 
 def whitelist_check_channel(nick, server):
     """Check if nick is on a whitelisted channel on server"""
-    channels = [x for x
-                in config.get_value('whitelists', 'channels').split(" ")
-                if x]
-
-    for channel in channels:
-        # Check for localised channel
-        if '@' in channel:
-            (channel, whitelisted_server) = (
-                channel.split('@', 1)
-            )
+    channels = membership.channels(server, nick)
+    return not channels.isdisjoint(matcher.channels_for(server))
 
-            # Skip if channel is for another server
-            if server != whitelisted_server:
-                continue
 
-        channel_nicks = whitelist_get_channel_nicks(server, channel)
+def whitelist_is_whitelisted(nick, host, server):
+    """Run the whitelist checks for a sender."""
+    # FIRST: Check if we have whitelisted things on this network.
+    if timings.timed("server", whitelist_check_server, nick, server):
+        return True
 
-        # Check if the nick is in the channel.
-        if nick in channel_nicks:
-            return True
+    # SECOND: Check the nicks.
+    if timings.timed("nick", whitelist_check_nick, nick, server):
+        return True
+
+    # THIRD: Check the hosts.
+    if timings.timed("host", whitelist_check_host, host, server):
+        return True
+
+    # FOURTH: Check the channels.
+    if timings.timed("channel", whitelist_check_channel, nick, server):
+        return True
 
     return False
 
@@ -592,36 +2517,34 @@ def whitelist_check(message):
     nick = message.nick()
     host = message.host()
     server = message.server()
+    flood_key = (server, host.split('@', 1)[-1])
 
-    # FIRST: Check if we have whitelisted things on this network.
-    if whitelist_check_server(nick, server):
-        return False
+    whitelisted = timings.timed("cache", verdicts.get, server, nick, host)
+    if whitelisted is None:
+        whitelisted = whitelist_is_whitelisted(nick, host, server)
+        verdicts.put(server, nick, host, whitelisted)
 
-    # SECOND: Check the nicks.
-    if whitelist_check_nick(nick, server):
+    if whitelisted:
         return False
 
-    # THIRD: Check the hosts.
-    if whitelist_check_host(host, server):
-        return False
+    # Hosts that have used up their bucket are dropped without notifying,
+    # logging or holding the message.
+    if flood.is_flooding(flood_key):
+        if config.get_value('general', 'notification'):
+            notifier.notify(server, nick, host, flooded=True)
+        return True
 
-    # FOURTH: Check the channels.
-    if whitelist_check_channel(nick, server):
-        return False
+    flood.consume(flood_key)
 
     # Place a notification in the status window
     if config.get_value('general', 'notification'):
-        weechat.prnt(
-            "",
-            "[{server}] {nick} [{host}] "
-            "attempted to send you a private message.".format(
-                server=server,
-                nick=nick,
-                host=host))
+        timings.timed("notify", notifier.notify, server, nick, host)
 
     # Log the message
     if config.get_value('general', 'logging'):
-        whitelist_log(
+        timings.timed(
+            "log",
+            whitelist_log,
             "{time}: [{server}] {nick} [{host}]: {message}\n".format(
                 time=time.asctime(),
                 server=server,
@@ -629,15 +2552,39 @@ def whitelist_check(message):
                 host=host,
                 message=message.message()))
 
+    # Hold it in case the sender is accepted
+    held.add(server, nick, host, message.message())
+
+    # Keep it where /whitelist blocked can find it
+    if quarantine.enabled:
+        timings.timed(
+            "store",
+            quarantine.add,
+            server,
+            nick,
+            host,
+            message.message())
+
     # Block it
     return True
 
 
-def whitelist_privmsg_modifier_cb(userdata, modifier, server, raw_irc_msg):
-    """Modifies the raw_irc_msg depending on whitelisted status."""
+def whitelist_parse_message(server, raw_irc_msg):
+    """Return a Message for raw_irc_msg, or None if it's not a query."""
     message = Message(server, raw_irc_msg)
 
     if message.is_query():
+        return message
+
+    return None
+
+
+def whitelist_privmsg_modifier(server, raw_irc_msg):
+    """Return raw_irc_msg, or an empty string if it should be blocked."""
+    message = timings.timed(
+        "parse", whitelist_parse_message, server, raw_irc_msg)
+
+    if message is not None:
         block = whitelist_check(message)
         if block:
             return ""
@@ -647,38 +2594,124 @@ def whitelist_privmsg_modifier_cb(userdata, modifier, server, raw_irc_msg):
     return raw_irc_msg
 
 
+def whitelist_privmsg_modifier_cb(userdata, modifier, server, raw_irc_msg):
+    """Modifies the raw_irc_msg depending on whitelisted status."""
+    if profiler is not None:
+        return profiler.runcall(
+            whitelist_privmsg_modifier, server, raw_irc_msg)
+
+    return timings.timed(
+        "total", whitelist_privmsg_modifier, server, raw_irc_msg)
+
+
 def whitelist_list():
     """Lists all whitelist details."""
     for section in SCRIPT_CONFIG['whitelists']:
-        value = config.get_value('whitelists', section)
+        value = entries.value(section)
         text = "{section}: {value}".format(section=section, value=value)
         weechat.prnt("", text)
 
 
-def whitelist_add(listtype, arg):
-    """Add entry to the given whitelist type."""
-    # Create a list from the current setting
-    values = config.get_value('whitelists', listtype).split()
+def whitelist_stats_reset():
+    """Reset all statistics counters."""
+    verdicts.reset_stats()
+    held.reset_stats()
+    flood.dropped = 0
+    blocked_log.dropped = 0
+    quarantine.dropped = 0
+    timings.reset()
+    weechat.prnt("", "Whitelist statistics reset.")
+
+
+def whitelist_profile(state):
+    """Start or stop profiling the modifier with cProfile."""
+    global profiler
+
+    if state == 'on':
+        if profiler is None:
+            profiler = cProfile.Profile()
+            weechat.prnt("", "Whitelist profiling started.")
+        return
+
+    if state != 'off':
+        weechat.prnt("", "Error. Usage: /whitelist profile on|off")
+        return
+
+    if profiler is None:
+        weechat.prnt("", "Whitelist profiling is not running.")
+        return
+
+    path = "{weechat_dir}/whitelist.{time}.prof".format(
+        weechat_dir=WEECHAT_DIR,
+        time=time.strftime("%Y%m%d-%H%M%S"))
+    profiler.dump_stats(path)
+    profiler = None
+
+    weechat.prnt("", "Whitelist profile written to {path}".format(path=path))
+
+
+def whitelist_stats():
+    """Print cache, flood protection, write error and timing statistics."""
+    lookups = verdicts.hits + verdicts.misses
+    ratio = 100.0 * verdicts.hits / lookups if lookups else 0.0
+
+    weechat.prnt("", "Verdict cache: {size}/{max_size} entries, "
+                     "TTL {ttl}s".format(
+                         size=len(verdicts),
+                         max_size=verdicts.size,
+                         ttl=verdicts.ttl))
+    weechat.prnt("", "Verdict cache: {hits} hits, {misses} misses "
+                     "({ratio:.1f}% hit rate)".format(
+                         hits=verdicts.hits,
+                         misses=verdicts.misses,
+                         ratio=ratio))
+    weechat.prnt("", "Flood protection: {dropped} messages dropped".format(
+        dropped=flood.dropped))
+    weechat.prnt("", "Held messages: {count}/{size} from {senders} senders, "
+                     "{evicted} dropped as the oldest, {capped} dropped over "
+                     "the per sender limit".format(
+                         count=len(held),
+                         size=held.size,
+                         senders=held.senders(),
+                         evicted=held.evicted,
+                         capped=held.capped))
+    weechat.prnt("", "Blocked log: {dropped} lines lost to write "
+                     "errors".format(dropped=blocked_log.dropped))
+    weechat.prnt("", "Quarantine: {dropped} messages lost to write "
+                     "errors".format(dropped=quarantine.dropped))
+
+    for line in timings.lines():
+        weechat.prnt("", line)
+
+
+def whitelist_save(listtype, added=(), removed=()):
+    """Save changes to a whitelist to the database or its option."""
+    if not store.enabled:
+        entries.save(config, listtype)
+        return
 
-    # Add the new value to the list.
-    values.append(arg)
+    try:
+        store.update(listtype, added, removed)
+    except sqlite3.Error as err:
+        weechat.prnt("", "Whitelist error. Can't write {path}: {err}".format(
+            path=store.path, err=err))
+
+    if not entries.batching:
+        whitelist_rebuild()
+        whitelist_print_type(listtype)
 
-    # Set the new option value. We use a set here to ensure uniqueness and
-    # we sort it just so that output is nicer.
-    config.set_value(
-        'whitelists',
-        listtype,
-        " ".join(sorted(set(values))))
+
+def whitelist_add(listtype, arg):
+    """Add entry to the given whitelist type."""
+    if entries.add(listtype, arg):
+        whitelist_save(listtype, added=(arg,))
 
 
 def whitelist_del(listtype, arg):
     """Remove entry from the given whitelist type."""
-    values = config.get_value('whitelists', listtype).split()
-
-    try:
-        values.remove(arg)
-        config.set_value('whitelists', listtype, " ".join(values))
-    except ValueError:
+    if entries.remove(listtype, arg):
+        whitelist_save(listtype, removed=(arg,))
+    else:
         text = "Whitelist error. '{arg}' not found in '{type}'.".format(
                 arg=arg,
                 type=listtype)
@@ -686,6 +2719,208 @@ def whitelist_del(listtype, arg):
         weechat.prnt("", text)
 
 
+def whitelist_path(path):
+    """Expand a path given to import or export.
+
+    Relative paths are taken to be in the WeeChat directory.
+    """
+    return os.path.join(WEECHAT_DIR, os.path.expanduser(path))
+
+
+def whitelist_import(path):
+    """Add the entries in a file, as written by export, to the whitelists.
+
+    Each line is a whitelist type and an entry. Blank lines and lines
+    starting with # are ignored.
+    """
+    path = whitelist_path(path)
+    added = dict((listtype, []) for listtype in SCRIPT_CONFIG['whitelists'])
+    existing = 0
+    skipped = 0
+
+    try:
+        with open(path) as import_file:
+            for line in import_file:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+
+                try:
+                    (listtype, arg) = line.split()
+                except ValueError:
+                    skipped += 1
+                    continue
+
+                listtype = WHITELIST_TYPE_ALIAS.get(listtype, listtype)
+                if listtype not in added:
+                    skipped += 1
+                elif entries.add(listtype, arg):
+                    added[listtype].append(arg)
+                else:
+                    existing += 1
+    except (IOError, OSError) as err:
+        weechat.prnt("", "Whitelist error. Can't import {path}: {err}".format(
+            path=path, err=err))
+        return
+
+    # Write each changed whitelist once, then rebuild once for all of them.
+    entries.batching = True
+    try:
+        for (listtype, args) in added.items():
+            if args:
+                whitelist_save(listtype, added=args)
+    finally:
+        entries.batching = False
+
+    whitelist_rebuild()
+
+    weechat.prnt("", "Whitelist import from {path}: {added} added ({types}), "
+                     "{existing} already whitelisted, {skipped} "
+                     "skipped.".format(
+                         path=path,
+                         added=sum(len(args) for args in added.values()),
+                         types=", ".join(
+                             "{count} {type}".format(count=len(args),
+                                                     type=name)
+                             for (name, args) in sorted(added.items())),
+                         existing=existing,
+                         skipped=skipped))
+
+
+def whitelist_export(path):
+    """Write every whitelist entry to a file that import can read."""
+    path = whitelist_path(path)
+    count = 0
+
+    try:
+        with open(path, 'w') as export_file:
+            for listtype in sorted(SCRIPT_CONFIG['whitelists']):
+                for arg in sorted(entries.get(listtype)):
+                    export_file.write("{type} {arg}\n".format(
+                        type=listtype, arg=arg))
+                    count += 1
+    except (IOError, OSError) as err:
+        weechat.prnt("", "Whitelist error. Can't export to {path}: "
+                         "{err}".format(path=path, err=err))
+        return
+
+    weechat.prnt("", "Whitelist export to {path}: {count} entries.".format(
+        path=path, count=count))
+
+
+def whitelist_accept(nick):
+    """Whitelist nick and deliver the messages held from them.
+
+    The nick is whitelisted on each server it has held messages from, or
+    everywhere if there are none. Held messages are matched without regard
+    to case, so the sender's nick as last seen on each server is the one
+    whitelisted. Held messages are printed in the query buffer with their
+    original time.
+    """
+    taken = held.take(nick)
+    if not taken:
+        whitelist_add('nicks', nick)
+        weechat.prnt("", "Whitelist: no messages held from {nick}.".format(
+            nick=nick))
+        return
+
+    # The nick from the host of the latest message held on each server.
+    nicks = {
+        server: messages[-1][1].split('!', 1)[0]
+        for (server, messages) in taken.items()
+    }
+
+    entries.batching = True
+    try:
+        for (server, sender) in nicks.items():
+            arg = "{nick}@{server}".format(nick=sender, server=server)
+            if entries.add('nicks', arg):
+                whitelist_save('nicks', added=(arg,))
+    finally:
+        entries.batching = False
+
+    whitelist_rebuild()
+
+    count = 0
+    for (server, messages) in sorted(taken.items()):
+        whitelist_deliver(server, nicks[server], messages)
+        count += len(messages)
+
+    weechat.prnt("", "Whitelist: accepted {nicks}, delivered {count} held "
+                     "messages.".format(
+                         nicks=", ".join(sorted(set(nicks.values()))),
+                         count=count))
+
+
+def whitelist_deliver(server, nick, messages):
+    """Print held (time, host, text) messages in the query with nick."""
+    weechat.command("", "/query -noswitch -server {server} {nick}".format(
+        server=server, nick=nick))
+    buf = weechat.info_get("irc_buffer", "{server},{nick}".format(
+        server=server, nick=nick))
+    nick_color = weechat.info_get("nick_color", nick)
+
+    for (timestamp, host, text) in messages:
+        tags = "notify_private,nick_{nick},host_{host},log1".format(
+            nick=nick, host=host.split('!', 1)[-1])
+
+        if text.startswith(CTCP_MARKER + "ACTION"):
+            line = "{prefix}{color}{nick}{reset} {text}".format(
+                prefix=weechat.prefix("action"),
+                color=nick_color,
+                nick=nick,
+                reset=weechat.color("reset"),
+                text=text[8:].rstrip(CTCP_MARKER))
+            tags = "irc_action," + tags
+        else:
+            line = "{color}{nick}\t{text}".format(
+                color=nick_color, nick=nick, text=text)
+
+        weechat.prnt_date_tags(buf, timestamp, tags, line)
+
+
+def whitelist_blocked(args):
+    """Print blocked messages, optionally searching by nick, host or text.
+
+    args are [nick|host|text <term>] [limit].
+    """
+    if not quarantine.enabled:
+        weechat.prnt("", "Whitelist error. The quarantine is disabled, "
+                         "see /set whitelist.general.quarantine")
+        return
+
+    args = args.split()
+    limit = QUARANTINE_DEFAULT_LIMIT
+    if args and args[-1].isdigit():
+        limit = int(args.pop())
+
+    (field, term) = (None, None)
+    if args:
+        if args[0] not in ('nick', 'host', 'text') or len(args) < 2:
+            weechat.prnt("", "Error. Usage: /whitelist blocked "
+                             "[nick|host|text <term>] [limit]")
+            return
+        (field, term) = (args[0], " ".join(args[1:]))
+
+    try:
+        rows = quarantine.search(field, term, limit)
+    except sqlite3.Error as err:
+        weechat.prnt("", "Whitelist error. Can't search {path}: {err}".format(
+            path=quarantine.path, err=err))
+        return
+
+    for (timestamp, server, nick, host, text) in rows:
+        weechat.prnt("", "{time}: [{server}] {nick} [{host}]: {text}".format(
+            time=time.asctime(time.localtime(timestamp)),
+            server=server,
+            nick=nick,
+            host=host,
+            text=text))
+
+    weechat.prnt("", "{count} blocked messages shown.".format(
+        count=len(rows)))
+
+
 def whitelist_cmd_split(count, args, default=None):
     """Split the whitelist command line"""
     # Hilarious.
@@ -705,6 +2940,38 @@ def whitelist_cmd(userdata, buf, args):
         whitelist_list()
         return weechat.WEECHAT_RC_OK
 
+    if cmd == 'stats':
+        if listtype == 'reset':
+            whitelist_stats_reset()
+        else:
+            whitelist_stats()
+        return weechat.WEECHAT_RC_OK
+
+    if cmd == 'profile':
+        whitelist_profile(listtype)
+        return weechat.WEECHAT_RC_OK
+
+    if cmd == 'accept':
+        if listtype is None:
+            weechat.prnt("", "Error. Usage: /whitelist accept <nick>")
+        else:
+            whitelist_accept(listtype)
+        return weechat.WEECHAT_RC_OK
+
+    if cmd == 'blocked':
+        whitelist_blocked(args.split(None, 1)[1] if listtype else "")
+        return weechat.WEECHAT_RC_OK
+
+    if cmd in ('import', 'export'):
+        if listtype is None:
+            weechat.prnt("", "Error. Usage: /whitelist {cmd} <file>".format(
+                cmd=cmd))
+        elif cmd == 'import':
+            whitelist_import(args.split(None, 1)[1])
+        else:
+            whitelist_export(args.split(None, 1)[1])
+        return weechat.WEECHAT_RC_OK
+
     if listtype in VALID_OPTION_TYPES:
         try:
             listtype = WHITELIST_TYPE_ALIAS[listtype]
@@ -747,37 +3014,104 @@ def version_check(required_version):
 
 if __name__ == '__main__':
     if weechat.register(SCRIPT_NAME, SCRIPT_AUTHOR, SCRIPT_VERSION,
-                        SCRIPT_LICENSE, SCRIPT_DESC, "", ""):
+                        SCRIPT_LICENSE, SCRIPT_DESC,
+                        "whitelist_unload_cb", ""):
 
         WEECHAT_DIR = weechat.info_get("weechat_dir", "")
 
-        # We need >= 1.3.0 for the message parsing support
+        # We need >= 1.3.0
         version_check(WEECHAT_VERSION_HEX_1_3_0)
 
+        addresses = ServerAddresses()
+        entries = WhitelistEntries()
+        store = WhitelistStore()
+        matcher = WhitelistMatcher()
+        membership = MembershipIndex()
+        verdicts = VerdictCache()
+        flood = FloodGuard()
+        timings = StageTimings()
+        profiler = None
+        notifier = BlockedNotifier()
+        blocked_log = BlockedLog(
+            "{weechat_dir}/whitelist.log".format(weechat_dir=WEECHAT_DIR))
+        held = HeldMessages()
+        quarantine = Quarantine(
+            "{weechat_dir}/whitelist_blocked.db".format(
+                weechat_dir=WEECHAT_DIR))
+
         config = Config(
             'whitelist',
             'whitelist_config_reload_cb',
-            '')
+            '',
+            'whitelist_config_value_change_cb')
 
         if config.is_ok():
             config.read()
+            whitelist_open_store()
+            verdicts.configure(
+                config.get_value('general', 'cache_size'),
+                config.get_value('general', 'cache_ttl'))
+            blocked_log.configure(
+                config.get_value('general', 'log_flush_interval'),
+                config.get_value('general', 'log_max_lines'),
+                config.get_value('general', 'log_rotate_size') * 1024)
+            whitelist_quarantine_configure()
+            quarantine.compact()
+            held.configure(
+                config.get_value('general', 'hold_size'),
+                config.get_value('general', 'hold_per_sender'))
+            flood.configure(
+                config.get_value('general', 'flood_burst'),
+                config.get_value('general', 'flood_rate'))
+            notifier.interval = config.get_value(
+                'general', 'notification_interval')
+            timings.enabled = bool(config.get_value('general', 'timing'))
 
         weechat.hook_modifier(
             "irc_in_privmsg",
             "whitelist_privmsg_modifier_cb",
             "")
 
+        for signal in MEMBERSHIP_SIGNALS:
+            weechat.hook_signal(
+                signal,
+                "whitelist_membership_signal_cb",
+                "")
+
+        for signal in ("irc_server_connected", "irc_server_disconnected"):
+            weechat.hook_signal(
+                signal,
+                "whitelist_server_signal_cb",
+                "")
+
         weechat.hook_command(
             SCRIPT_COMMAND,
             "Manage the whitelist",
             # OPTION ARGUMENTS
             "list"
             " || add <type> <arg>"
-            " || del <type> <arg>",
+            " || del <type> <arg>"
+            " || stats [reset]"
+            " || profile on|off"
+            " || import|export <file>"
+            " || blocked [nick|host|text <term>] [limit]"
+            " || accept <nick>",
             # ARGUMENT DESCRIPTIONS
             "      list: lists whitelists and their contents\n"
             "       add: add an entry to a given whitelist\n"
             "       del: delete an entry from a given whitelist\n"
+            "     stats: show cache, flood protection and timing "
+            "statistics, or reset them\n"
+            "   profile: start profiling, or stop and write the profile "
+            "to the WeeChat directory\n"
+            "    import: add the entries in a file, one '<type> <arg>' per "
+            "line\n"
+            "    export: write all entries to a file, in the format import "
+            "reads\n"
+            "   blocked: show the newest blocked messages, or search them "
+            "by nick, host (* is a wildcard) or text\n"
+            "    accept: whitelist a nick and show the messages held from "
+            "them in a query\n"
             "\n"
             "Examples:\n"
             "  Add entries to whitelist:\n"
@@ -785,11 +3119,23 @@ if __name__ == '__main__':
             "    /whitelist add host *!buddy@*.isp.com\n"
             "  Delete entries from whitelist:\n"
             "    /whitelist del nick Someguy\n"
-            "    /whitelist del chan[nel] #weechat\n",
+            "    /whitelist del chan[nel] #weechat\n"
+            "  Copy the whitelists to another WeeChat:\n"
+            "    /whitelist export whitelist.txt\n"
+            "    /whitelist import whitelist.txt\n"
+            "  Search blocked messages:\n"
+            "    /whitelist blocked host *.isp.com 50\n"
+            "    /whitelist blocked text free money\n",
             # COMPLETIONS
             "list %(whitelist_args)"
             " || add %(whitelist_args)"
-            " || del %(whitelist_args)",
+            " || del %(whitelist_args)"
+            " || stats reset"
+            " || profile on|off"
+            " || import %(filename)"
+            " || export %(filename)"
+            " || blocked nick|host|text"
+            " || accept",
             # COMMAND TO CALL + USERDATA
             "whitelist_cmd",
             "")
@@ -23,6 +23,12 @@
 #
 # History:
 #
+# 2026-10-18, phyber:
+#     version 0.5: collect replies until the end of the whois and print them
+#                  together, read settings once on change.
+# 2026-10-18, phyber:
+#     version 0.4: dispatch numerics through a table of formatters, with
+#                  colors looked up once and refreshed on color changes.
 # 2009-12-22, Bazerka <bazerka@quakenet.org>:
 #     version 0.3: fix silly typo bug in idle time calculations.
 # 2009-12-22, Bazerka <bazerka@quakenet.org>:
@@ -33,7 +39,7 @@
 
 SCRIPT_NAME    = "whois_in_active_buffer"
 SCRIPT_AUTHOR  = "Bazerka <bazerka@quakenet.org>"
-SCRIPT_VERSION = "0.3"
+SCRIPT_VERSION = "0.5"
 SCRIPT_LICENSE = "GPL3"
 SCRIPT_DESC    = "Display whois in active buffer"
 
@@ -56,99 +62,141 @@ except ImportError as message:
 settings = {
   "redirect_pv_whois": "on",
   "keep_server_buffer_output": "off",
+  "reply_timeout": "5",
 }
 
+# Current settings, read by load_settings() when they change.
+options = {}
 
-def numeric_handler(numeric, data, buffer):
-    print_data = ""
-    print_format = ""
-    if numeric in [307,310,313,318,319,320,378,379,401,406,671]:
-        nick, message = data[3:5]
-        print_data = {
-          "nick": nick,
-          "message": message,
-        }
-        print_format = '%(C)s%(message)s'
-    elif numeric == 301:
-        nick, away_message = data[3:5]
-        print_data = {
-          "nick": nick,
-          "away_message": away_message,
-        }
-        print_format = '%(C)sis away: %(away_message)s'
-    elif numeric == 311:
-        nick, username, host = data[3:6]
-        realname = data[7]
-        print_data = {
-          "nick": nick,
-          "username": username,
-          "host": host,
-          "realname": realname,
-        }
-        print_format = '%(CD)s(%(CH)s%(username)s@%(host)s%(CD)s)%(C)s: %(realname)s'
-    elif numeric == 312:
-        nick, server, server_desc = data[3:6]
-        print_data = {
-          "nick": nick,
-          "server": server,
-          "server_desc": server_desc,
-        }
-        print_format = '%(C)s%(server)s %(CD)s(%(C)s%(server_desc)s%(CD)s)'
-    elif numeric == 317:
-        nick, idle, signon, message = data[3:7]
-        m , s = divmod(int(idle), 60)
-        h , m = divmod(m, 60)
-        d , h = divmod(h, 24)
-        if d > 0:
-            idletime = "%%(C)s%%(B)s%d %%(C)sdays, %%(B)s%02d %%(C)shours %%(B)s%02d %%(C)sminutes %%(B)s%02d %%(C)sseconds" % (d, h, m, s)
-        else:
-            idletime = "%%(C)s%%(B)s%02d %%(C)shours %%(B)s%02d %%(C)sminutes %%(B)s%02d %%(C)sseconds" % (h, m, s)
-        signontime = time.ctime(int(signon))
-        print_data = {
-          "nick": nick,
-          "signon": signontime,
-        }
-        print_format = '%%(C)sidle: %s, signon at: %%(B)s%%(signon)s' % idletime
-    elif numeric == 330:
-        nick, away_message = data[3:5]
-        print_data = {
-          "nick": nick,
-          "away_message": away_message,
-        }
-        print_format = '%(C)sis away: %(away_message)s'
-    elif numeric == 338:
-        nick, actual_ip, message = data[3:6]
-        print_data = {
-          "nick": nick,
-          #"actual_userhost": actual_userhost,
-          "actual_ip": actual_ip,
-          "message": message,
-        }
-        #print_format = '%(C)s%(message)s: %(CH)s%(actual_userhost)s %(CD)s(%(C)s%(actual_ip)s%(CD)s)'
-        print_format = '%(C)s%(message)s: %(CD)s(%(C)s%(actual_ip)s%(CD)s)'
+# (server, nick) -> replies collected until the end of the whois
+pending = {}
+
+# Numerics that end a whois or whowas
+END_NUMERICS = (318, 369)
+
+
+# Colors and prefix used in output, filled by refresh_formats().
+colors = {}
+
+# numeric -> (values function, format with colors already filled in)
+formatters = {}
+
+# Idle time formats, with colors filled in by refresh_formats().
+idle_formats = {}
+
+HEADER_FORMAT = '%(P)s%(CD)s[%(CN)s%(nick)s%(CD)s] '
+
+IDLE_FORMATS = {
+  'days': "%(C)s%(B)s%%d %(C)sdays, %(B)s%%02d %(C)shours %(B)s%%02d %(C)sminutes %(B)s%%02d %(C)sseconds",
+  'hours': "%(C)s%(B)s%%02d %(C)shours %(B)s%%02d %(C)sminutes %(B)s%%02d %(C)sseconds",
+}
+
+def message_values(data):
+    nick, message = data[3:5]
+    return {
+      "nick": nick,
+      "message": message,
+    }
+
+def away_values(data):
+    nick, away_message = data[3:5]
+    return {
+      "nick": nick,
+      "away_message": away_message,
+    }
+
+def user_values(data):
+    nick, username, host = data[3:6]
+    realname = data[7]
+    return {
+      "nick": nick,
+      "username": username,
+      "host": host,
+      "realname": realname,
+    }
+
+def server_values(data):
+    nick, server, server_desc = data[3:6]
+    return {
+      "nick": nick,
+      "server": server,
+      "server_desc": server_desc,
+    }
+
+def idle_values(data):
+    nick, idle, signon, message = data[3:7]
+    m , s = divmod(int(idle), 60)
+    h , m = divmod(m, 60)
+    d , h = divmod(h, 24)
+    if d > 0:
+        idletime = idle_formats['days'] % (d, h, m, s)
     else:
-        debug('Unknown numeric: %s' % numeric)
-    if print_format and print_data and buffer:
-        print_output(print_format, print_data, buffer)
-                                                    
-def debug(s, prefix='debug', buffer=''):
-    weechat.prnt(buffer, '%s: %s' %(prefix, s))
+        idletime = idle_formats['hours'] % (h, m, s)
+    return {
+      "nick": nick,
+      "idle": idletime,
+      "signon": time.ctime(int(signon)),
+    }
 
-def print_output(stringformat, values, buffer):
-    formats = {
+def actual_ip_values(data):
+    nick, actual_ip, message = data[3:6]
+    return {
+      "nick": nick,
+      #"actual_userhost": actual_userhost,
+      "actual_ip": actual_ip,
+      "message": message,
+    }
+
+NUMERIC_FORMATS = {
+  301: (away_values, '%(C)sis away: %(away_message)s'),
+  311: (user_values, '%(CD)s(%(CH)s%(username)s@%(host)s%(CD)s)%(C)s: %(realname)s'),
+  312: (server_values, '%(C)s%(server)s %(CD)s(%(C)s%(server_desc)s%(CD)s)'),
+  317: (idle_values, '%(C)sidle: %(idle)s, signon at: %(B)s%(signon)s'),
+  330: (away_values, '%(C)sis away: %(away_message)s'),
+  #338: '%(C)s%(message)s: %(CH)s%(actual_userhost)s %(CD)s(%(C)s%(actual_ip)s%(CD)s)'
+  338: (actual_ip_values, '%(C)s%(message)s: %(CD)s(%(C)s%(actual_ip)s%(CD)s)'),
+}
+for numeric in [307,310,313,318,319,320,378,379,401,406,671]:
+    NUMERIC_FORMATS[numeric] = (message_values, '%(C)s%(message)s')
+
+class ColorFormat(dict):
+    """ Fills in colors, leaving the other keys for later. """
+    def __missing__(self, key):
+        return '%%(%s)s' % key
+
+def refresh_formats():
+    colors.clear()
+    colors.update({
       'CD': weechat.color('chat_delimiters'),
       'CN': weechat.color('chat_nick'),
       'CH': weechat.color('chat_host'),
       'C': weechat.color('chat'),
       'B': weechat.color('bold'),
       'P': weechat.prefix('network'),
-    }
-    if values:
-        formats.update(values)
-    if stringformat:
-        stringformat = '%s%s' % ('%(CD)s[%(CN)s%(nick)s%(CD)s] ',stringformat)
-        output = formats['P'] + stringformat % formats
-        weechat.prnt(buffer, output)                    
+    })
+    escaped = ColorFormat()
+    for key, value in colors.items():
+        escaped[key] = value.replace('%', '%%')
+    for key, idleformat in IDLE_FORMATS.items():
+        idle_formats[key] = idleformat % escaped
+    formatters.clear()
+    for numeric, (values, stringformat) in NUMERIC_FORMATS.items():
+        formatters[numeric] = (values, (HEADER_FORMAT + stringformat) % escaped)
+
+def color_config_cb(data, option, value):
+    refresh_formats()
+    return WEECHAT_RC_OK
+
+def numeric_handler(numeric, data):
+    try:
+        values, stringformat = formatters[numeric]
+    except KeyError:
+        debug('Unknown numeric: %s' % numeric)
+        return None
+    return stringformat % values(data)
+
+def debug(s, prefix='debug', buffer=''):
+    weechat.prnt(buffer, '%s: %s' %(prefix, s))
 
 def split_signal_data(sig_data):
     data = []
@@ -177,15 +225,61 @@ def is_server_buffer(buffer):
         return True
     return False
 
+def load_settings():
+    for option in settings:
+        options[option] = weechat.config_get_plugin(option)
+
+def settings_config_cb(data, option, value):
+    load_settings()
+    return WEECHAT_RC_OK
+
+def reply_timeout():
+    try:
+        return max(int(options['reply_timeout']), 1) * 1000
+    except ValueError:
+        return int(settings['reply_timeout']) * 1000
+
+class WhoisReply(object):
+    """ Replies for one whois, and where they are going. """
+    def __init__(self, server, nick):
+        if options['redirect_pv_whois'] == 'on':
+            self.buffer = find_query_buffer(nick, server)
+        else:
+            self.buffer = weechat.current_buffer()
+        self.keep = (options['keep_server_buffer_output'] == 'on' and
+                     not is_server_buffer(self.buffer))
+        self.lines = []
+        self.timer = weechat.hook_timer(reply_timeout(), 0, 1,
+                                        'whois_timeout_cb',
+                                        '%s %s' % (server, nick))
+
+    def flush(self):
+        if self.lines and self.buffer:
+            weechat.prnt(self.buffer, '\n'.join(self.lines))
+        self.lines = []
+
+def whois_timeout_cb(data, remaining_calls):
+    server, nick = data.split(' ', 1)
+    reply = pending.pop((server, nick.lower()), None)
+    if reply:
+        reply.flush()
+    return WEECHAT_RC_OK
+
 def whois_modifier_cb(data, modifier, modifier_data, string):
-    buffer = ""
     signal_data = split_signal_data(string)
-    if weechat.config_get_plugin('redirect_pv_whois') == 'on':
-        buffer = find_query_buffer(signal_data[3], modifier_data)
-    else:
-        buffer = weechat.current_buffer()
-    numeric_handler(int(modifier.split('_')[2]), signal_data, buffer)
-    if weechat.config_get_plugin('keep_server_buffer_output') == 'on' and not is_server_buffer(buffer):
+    numeric = int(modifier.split('_')[2])
+    key = (modifier_data, signal_data[3].lower())
+    reply = pending.get(key)
+    if reply is None:
+        reply = pending[key] = WhoisReply(modifier_data, signal_data[3])
+    line = numeric_handler(numeric, signal_data)
+    if line:
+        reply.lines.append(line)
+    if numeric in END_NUMERICS:
+        del pending[key]
+        weechat.unhook(reply.timer)
+        reply.flush()
+    if reply.keep:
         return string
     else:
         return ""
@@ -196,6 +290,11 @@ if __name__ == '__main__' and import_ok:
         for option, default_value in settings.items():
             if not weechat.config_is_set_plugin(option):
                 weechat.config_set_plugin(option, default_value)
+        load_settings()
+        weechat.hook_config('plugins.var.python.%s.*' % SCRIPT_NAME, 'settings_config_cb', '')
+        refresh_formats()
+        weechat.hook_config('weechat.color.*', 'color_config_cb', '')
+        weechat.hook_config('weechat.look.prefix_network', 'color_config_cb', '')
         for numeric in [301,307,310,311,312,313,314,317,318,319,320,338,330,369,378,379,401,406,671]: 
             weechat.hook_modifier('irc_in_%d' % numeric, 'whois_modifier_cb', '')
 